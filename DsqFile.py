@@ -135,7 +135,56 @@ class DsqFile:
         (size,) = read(fd, "<i")
         return fd.read(size).decode("cp1252")
 
-    def read(self, fd):
+    @classmethod
+    def read_sequence_names(cls, fd):
+        # Keyframe tables are skipped over, so this only reads the sequence table
+        dsq = cls()
+        dsq.read(fd, sequence_filter=())
+        return [seq.name for seq in dsq.sequences]
+
+    def read_sequence_keyframes(self, fd, offsets, sequence_filter):
+        def fill(table, name, first, count, read_item):
+            start, size = offsets[name]
+
+            for i in range(first, first + count):
+                if table[i] is None:
+                    fd.seek(start + i * size)
+                    table[i] = read_item(fd)
+
+        num_nodes = len(self.nodes)
+
+        for seq in self.sequences:
+            if seq.name not in sequence_filter:
+                continue
+
+            num_translations = sum(seq.translationMatters[:num_nodes]) * seq.numKeyframes
+            num_rotations = sum(seq.rotationMatters[:num_nodes]) * seq.numKeyframes
+            num_scales = sum(seq.scaleMatters[:num_nodes]) * seq.numKeyframes
+
+            fill(self.translations, "translations", seq.baseTranslation, num_translations, read_vec)
+            fill(self.rotations, "rotations", seq.baseRotation, num_rotations, read_quat)
+
+            if seq.flags & Sequence.UniformScale:
+                fill(self.uniform_scales, "uniform_scales", seq.baseScale, num_scales,
+                    lambda fd: read(fd, "<f"))
+            elif seq.flags & Sequence.AlignedScale:
+                fill(self.aligned_scales, "aligned_scales", seq.baseScale, num_scales, read_vec)
+
+    def read(self, fd, sequence_filter=None):
+        # With a sequence_filter, keyframes are only decoded for the
+        # sequences named in it and left as None otherwise
+        offsets = {}
+
+        def read_table(name, size, read_item):
+            (count,) = read(fd, "<i")
+
+            if sequence_filter is None:
+                return [read_item(fd) for i in range(count)]
+
+            offsets[name] = (fd.tell(), size)
+            fd.seek(count * size, 1)
+            return [None] * count
+
         (version,) = read(fd, "<i")
         assert version <= 24, "dsq >v24 not supported yet"
 
@@ -150,10 +199,10 @@ class DsqFile:
             assert false, "TODO: read keyframes from version < 17"
 
         if version > 21:
-            self.rotations = [read_quat(fd) for i in range(read(fd, "<i")[0])]
-            self.translations = [read_vec(fd) for i in range(read(fd, "<i")[0])]
-            self.uniform_scales = [read(fd, "<f") for i in range(read(fd, "<i")[0])]
-            self.aligned_scales = [read_vec(fd) for i in range(read(fd, "<i")[0])]
+            self.rotations = read_table("rotations", 8, read_quat)
+            self.translations = read_table("translations", 12, read_vec)
+            self.uniform_scales = read_table("uniform_scales", 4, lambda fd: read(fd, "<f"))
+            self.aligned_scales = read_table("aligned_scales", 12, read_vec)
             (sz,) = read(fd, "<i")
             self.arbitrary_scale_rots = [read_quat(fd) for i in range(sz)]
             self.arbitrary_scale_factors = [read_vec(fd) for i in range(sz)]
@@ -179,6 +228,11 @@ class DsqFile:
             self.sequences[i] = Sequence.read(fd, False)
             self.sequences[i].name = name
 
+        if offsets:
+            end = fd.tell()
+            self.read_sequence_keyframes(fd, offsets, sequence_filter)
+            fd.seek(end)
+
         # and finally, triggers
         if version > 8:
             (num_sjws,) = read(fd, "<i")
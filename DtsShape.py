@@ -418,8 +418,84 @@ class DtsShape(object):
 		for mat in self.materials:
 			ws(fd, "f", mat.reflectance)
 
-	def load(self, fd):
+	@classmethod
+	def read_sequence_names(cls, fd):
+		# Cheap scan for listing sequences without decoding the shape.
+		# Names are the last strings in the 8-bit buffer and the sequence
+		# table follows right after the three buffers.
+		dtsVersion, exporterVersion = unpack("hh", fd.read(4))
+		end8, end32, end16 = unpack("iii", fd.read(12))
+
+		# Position of the name count in the header
+		name_field = 5
+		name_field += 1 if dtsVersion < 22 else 5
+		name_field += 1 if dtsVersion > 23 else 0
+		name_field += 5
+		name_field += 1 if dtsVersion < 23 else 0
+		n_name = read_multi(fd, name_field + 1, "i")[name_field]
+
+		# Drop the padding, the final guard byte and the last terminator
+		fd.seek(16 + end16 * 4)
+		buffer8 = fd.read((end8 - end16) * 4).rstrip(b"\x00")[:-2]
+		names = buffer8.split(b"\x00")[-n_name:] if n_name else []
+		names = [name.decode("cp1252") for name in names]
+
+		fd.seek(16 + end8 * 4)
+		n_sequence = unpack("i", fd.read(4))[0]
+		sequence_names = []
+
+		for i in range(n_sequence):
+			seq = Sequence.read(fd)
+			sequence_names.append(names[seq.nameIndex])
+
+		return sequence_names
+
+	def read_sequence_keyframes(self, stream, offsets, sequence_filter):
+		n_node = len(self.nodes)
+
+		def fill(table, name, first, count, read):
+			tell, start, size = offsets[name]
+
+			for i in range(first, first + count):
+				if table[i] is None:
+					setattr(stream, tell, start + i * size)
+					table[i] = read()
+
+		for seq in self.sequences:
+			if self.names[seq.nameIndex] not in sequence_filter:
+				continue
+
+			num_translations = sum(seq.translationMatters[:n_node]) * seq.numKeyframes
+			num_rotations = sum(seq.rotationMatters[:n_node]) * seq.numKeyframes
+			num_scales = sum(seq.scaleMatters[:n_node]) * seq.numKeyframes
+
+			fill(self.node_translations, "translations", seq.baseTranslation, num_translations, stream.read_vec3)
+			fill(self.node_rotations, "rotations", seq.baseRotation, num_rotations, stream.read_quat)
+
+			if "uniform_scales" not in offsets:
+				continue
+
+			if seq.flags & Sequence.UniformScale:
+				fill(self.node_uniform_scales, "uniform_scales", seq.baseScale, num_scales, stream.read_float)
+			elif seq.flags & Sequence.AlignedScale:
+				fill(self.node_aligned_scales, "aligned_scales", seq.baseScale, num_scales, stream.read_vec3)
+			elif seq.flags & Sequence.ArbitraryScale:
+				fill(self.node_arbitrary_scale_factors, "arbitrary_scale_factors", seq.baseScale, num_scales, stream.read_vec3)
+				fill(self.node_arbitrary_scale_rots, "arbitrary_scale_rots", seq.baseScale, num_scales, stream.read_quat)
+
+	def load(self, fd, sequence_filter=None):
+		# With a sequence_filter, keyframes are only decoded for the
+		# sequences named in it and left as None otherwise
 		stream = DtsInputStream(fd)
+		offsets = {}
+
+		def read_table(name, count, tell, size, read):
+			if sequence_filter is None:
+				return [read() for i in range(count)]
+
+			offsets[name] = (tell, getattr(stream, tell), size)
+			setattr(stream, tell, getattr(stream, tell) + count * size)
+			return [None] * count
 
 		# Header
 		n_node = stream.read32()
@@ -511,16 +587,16 @@ class DtsShape(object):
 			self.default_translations[i] = stream.read_vec3()
 
 		# Animation translations and rotations
-		self.node_translations = [stream.read_vec3() for i in range(n_nodetranslation)]
-		self.node_rotations = [stream.read_quat() for i in range(n_noderotation)]
+		self.node_translations = read_table("translations", n_nodetranslation, "tell32", 3, stream.read_vec3)
+		self.node_rotations = read_table("rotations", n_noderotation, "tell16", 4, stream.read_quat)
 		stream.guard()
 
 		# Default scales
 		if stream.dtsVersion > 21:
-			self.node_uniform_scales = [stream.read_float() for i in range(n_nodescaleuniform)]
-			self.node_aligned_scales = [stream.read_vec3() for i in range(n_nodescalealigned)]
-			self.node_arbitrary_scale_factors = [stream.read_vec3() for i in range(n_nodescalearbitrary)]
-			self.node_arbitrary_scale_rots = [stream.read_quat() for i in range(n_nodescalearbitrary)]
+			self.node_uniform_scales = read_table("uniform_scales", n_nodescaleuniform, "tell32", 1, stream.read_float)
+			self.node_aligned_scales = read_table("aligned_scales", n_nodescalealigned, "tell32", 3, stream.read_vec3)
+			self.node_arbitrary_scale_factors = read_table("arbitrary_scale_factors", n_nodescalearbitrary, "tell32", 3, stream.read_vec3)
+			self.node_arbitrary_scale_rots = read_table("arbitrary_scale_rots", n_nodescalearbitrary, "tell16", 4, stream.read_quat)
 			stream.guard()
 		else:
 			self.node_uniform_scales = [None] * n_nodescaleuniform
@@ -591,6 +667,9 @@ class DtsShape(object):
 		for i in range(n_sequence):
 			self.sequences[i] = Sequence.read(fd)
 
+		if sequence_filter is not None:
+			self.read_sequence_keyframes(stream, offsets, sequence_filter)
+
 		material_type = unpack("b", fd.read(1))[0]
 		assert material_type == 0x1
 
@@ -39,11 +39,54 @@ from bpy.props import (BoolProperty,
                        StringProperty,
                        EnumProperty,
                        PointerProperty,
+                       CollectionProperty,
                        )
 from bpy_extras.io_utils import (ImportHelper,
                                  ExportHelper,
                                  )
 
+class SequenceSelection(bpy.types.PropertyGroup):
+    name = StringProperty(name="Name")
+    select = BoolProperty(name="Import", default=True)
+
+def update_sequence_list(operator, read_sequence_names):
+    # Called from check() whenever the file browser selection changes
+    if operator.filepath == operator.sequences_path:
+        return False
+
+    operator.sequences_path = operator.filepath
+    operator.sequences.clear()
+
+    try:
+        with open(operator.filepath, "rb") as fd:
+            names = read_sequence_names(fd)
+    except Exception:
+        names = ()
+
+    for name in names:
+        item = operator.sequences.add()
+        item.name = name
+
+    return True
+
+def draw_sequence_list(operator, layout):
+    if not operator.sequences:
+        return
+
+    box = layout.box()
+    box.label("Sequences ({}):".format(len(operator.sequences)))
+
+    col = box.column(align=True)
+    for item in operator.sequences:
+        col.prop(item, "select", text=item.name)
+
+def sequence_keywords(operator, keywords):
+    # Only filter when the list was filled in, so scripted calls import everything
+    if operator.sequences:
+        keywords["sequence_filter"] = {item.name for item in operator.sequences if item.select}
+
+    return keywords
+
 class ImportDTS(bpy.types.Operator, ImportHelper):
     """Load a Torque DTS File"""
     bl_idname = "import_scene.dts"
@@ -68,9 +111,18 @@ class ImportDTS(bpy.types.Operator, ImportHelper):
         default=True,
         )
 
+    sequence_mode = EnumProperty(
+        name="Sequences as",
+        description="How embedded sequences are laid out in Blender",
+        default="timeline",
+        items=(
+            ("timeline", "Timeline", "Place all sequences one after another on the scene timeline, with markers"),
+            ("actions", "Actions", "Import every sequence into separate actions (one per node, or one per armature)"))
+        )
+
     use_armature = BoolProperty(
         name="Experimental: Skeleton as armature",
-        description="Import bones into an armature instead of empties. Does not work with 'Import sequences'",
+        description="Import bones into an armature instead of empties. Sequences are only supported as actions",
         default=False,
         )
 
@@ -81,11 +133,33 @@ class ImportDTS(bpy.types.Operator, ImportHelper):
         default=False,
         )
 
+    sequences = CollectionProperty(type=SequenceSelection, options={'HIDDEN', 'SKIP_SAVE'})
+    sequences_path = StringProperty(options={'HIDDEN', 'SKIP_SAVE'})
+
+    def check(self, context):
+        from .DtsShape import DtsShape
+        return update_sequence_list(self, DtsShape.read_sequence_names)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "reference_keyframe")
+        layout.prop(self, "import_sequences")
+
+        sublayout = layout.column()
+        sublayout.enabled = self.import_sequences
+        sublayout.prop(self, "sequence_mode")
+        draw_sequence_list(self, sublayout)
+
+        layout.prop(self, "use_armature")
+
+        if is_developer:
+            layout.prop(self, "debug_report")
+
     def execute(self, context):
         from . import import_dts
 
-        keywords = self.as_keywords(ignore=("filter_glob", "split_mode"))
-        return import_dts.load(self, context, **keywords)
+        keywords = self.as_keywords(ignore=("filter_glob", "split_mode", "sequences", "sequences_path"))
+        return import_dts.load(self, context, **sequence_keywords(self, keywords))
 
 class ImportDSQ(bpy.types.Operator, ImportHelper):
     """Load a Torque DSQ File"""
@@ -106,11 +180,25 @@ class ImportDSQ(bpy.types.Operator, ImportHelper):
         default=False,
         )
 
+    sequences = CollectionProperty(type=SequenceSelection, options={'HIDDEN', 'SKIP_SAVE'})
+    sequences_path = StringProperty(options={'HIDDEN', 'SKIP_SAVE'})
+
+    def check(self, context):
+        from .DsqFile import DsqFile
+        return update_sequence_list(self, DsqFile.read_sequence_names)
+
+    def draw(self, context):
+        layout = self.layout
+        draw_sequence_list(self, layout)
+
+        if is_developer:
+            layout.prop(self, "debug_report")
+
     def execute(self, context):
         from . import import_dsq
 
-        keywords = self.as_keywords(ignore=("filter_glob", "split_mode"))
-        return import_dsq.load(self, context, **keywords)
+        keywords = self.as_keywords(ignore=("filter_glob", "split_mode", "sequences", "sequences_path"))
+        return import_dsq.load(self, context, **sequence_keywords(self, keywords))
 
 class ExportDTS(bpy.types.Operator, ExportHelper):
     """Save a Torque DTS File"""
@@ -172,6 +260,69 @@ class ExportDTS(bpy.types.Operator, ExportHelper):
         default=True,
         )
 
+    optimize_cache = BoolProperty(
+        name="Optimize vertex cache",
+        description="Reorder triangles and vertices of each material group for the GPU vertex cache",
+        default=False,
+        )
+
+    use_strips = BoolProperty(
+        name="Triangle strips",
+        description="Write triangle strips instead of lists for materials where that needs fewer indices",
+        default=False,
+        )
+
+    max_influences = IntProperty(
+        name="Max influences",
+        description="Keep only the strongest bone weights of each vertex, 0 for no limit",
+        default=0,
+        min=0,
+        max=16,
+        )
+
+    min_weight = FloatProperty(
+        name="Min weight",
+        description="Drop bone weights below this and renormalize the rest",
+        default=0.0,
+        min=0.0,
+        max=1.0,
+        )
+
+    weight_steps = IntProperty(
+        name="Weight steps",
+        description="Round bone weights to multiples of 1/steps, 0 to keep them exact",
+        default=0,
+        min=0,
+        max=65535,
+        )
+
+    max_bones = IntProperty(
+        name="Max bones",
+        description="Split skinned meshes into pieces that each use at most this many bones, 0 for no limit",
+        default=0,
+        min=0,
+        max=256,
+        )
+
+    prune_unused_nodes = BoolProperty(
+        name="Prune unused nodes",
+        description="Remove nodes with nothing attached and no animation, folding their transforms into their children",
+        default=False,
+        )
+
+    merge_static = BoolProperty(
+        name="Merge static objects",
+        description="Combine unanimated, unskinned objects attached to the same node into one object",
+        default=False,
+        )
+
+    generate_lods = StringProperty(
+        name="Generate LODs",
+        description="Detail levels to generate from the most detailed mesh as size:ratio pairs, "
+                    "for example \"64:0.5, 16:0.2\"",
+        default="",
+        )
+
     debug_report = BoolProperty(
         name="Write debug report",
         description="Dump out all the information from the DTS to a file",
@@ -226,8 +377,30 @@ class SplitMeshIndex(bpy.types.Operator):
     bl_label = "Split mesh by indices"
     bl_options = {"REGISTER", "UNDO"}
 
+    limit = IntProperty(
+        name="Limit",
+        description="Maximum number of loops or indices in each new mesh",
+        default=65535,
+        min=3,
+        )
+
+    limit_type = EnumProperty(
+        name="Count",
+        description="What the limit applies to",
+        default="indices",
+        items=(
+            ("indices", "Indices", "Triangle indices after triangulation, 3 per triangle"),
+            ("loops", "Loops", "Face corners of the polygons as they are"))
+        )
+
+    balance = BoolProperty(
+        name="Balance chunks",
+        description="Give every new mesh about the same size instead of filling each one up to the limit",
+        default=False,
+        )
+
     def execute(self, context):
-        limit = 10922
+        import numpy as np
 
         ob = context.active_object
 
@@ -237,57 +410,93 @@ class SplitMeshIndex(bpy.types.Operator):
 
         me = ob.data
 
-        out_me = None
-        out_ob = None
-
-        def split():
-            nonlocal out_me
-            nonlocal out_ob
+        co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+        me.vertices.foreach_get("co", co)
+        co.shape = (-1, 3)
+
+        loop_verts = np.empty(len(me.loops), dtype=np.int32)
+        me.loops.foreach_get("vertex_index", loop_verts)
+
+        num_polys = len(me.polygons)
+        loop_start = np.empty(num_polys, dtype=np.int32)
+        loop_total = np.empty(num_polys, dtype=np.int32)
+        use_smooth = np.empty(num_polys, dtype=bool)
+        material_index = np.empty(num_polys, dtype=np.int32)
+        me.polygons.foreach_get("loop_start", loop_start)
+        me.polygons.foreach_get("loop_total", loop_total)
+        me.polygons.foreach_get("use_smooth", use_smooth)
+        me.polygons.foreach_get("material_index", material_index)
+
+        uv_layers = []
+        for layer in me.uv_layers:
+            uvs = np.empty(len(me.loops) * 2, dtype=np.float32)
+            layer.data.foreach_get("uv", uvs)
+            uv_layers.append((layer.name, uvs.reshape(-1, 2)))
+
+        if self.limit_type == "indices":
+            cost = (loop_total - 2) * 3
+        else:
+            cost = loop_total
+
+        # Polygons that cannot fit anywhere are left out
+        polys = np.flatnonzero(cost <= self.limit)
+        skipped = num_polys - len(polys)
+
+        if not len(polys):
+            self.report({"ERROR"}, "No polygons fit within the limit")
+            return {"FINISHED"}
 
-            if out_me is not None:
-                out_me.validate()
-                out_me.update()
+        # Assign consecutive polygons to chunks by their running cost. Keeping
+        # the chunk size a polygon below the limit means no chunk exceeds it.
+        cost = cost[polys]
+        ends = np.cumsum(cost)
+        target = self.limit - int(cost.max()) + 1
 
-            out_me = bpy.data.meshes.new(ob.name)
-            out_ob = bpy.data.objects.new(ob.name, out_me)
+        if self.balance:
+            num_chunks = int(np.ceil(ends[-1] / target))
+            target = ends[-1] / num_chunks
 
-            context.scene.objects.link(out_ob)
+        chunks = ((ends - 1) // target).astype(np.int64)
 
-            # For now, copy all verts over. See what happens?
-            out_me.vertices.add(len(me.vertices))
+        for chunk in np.unique(chunks):
+            chunk_polys = polys[chunks == chunk]
+            totals = loop_total[chunk_polys]
+            starts = np.concatenate(([0], np.cumsum(totals)[:-1]))
 
-            for vert, out_vert in zip(me.vertices, out_me.vertices):
-                out_vert.co = vert.co
-                out_vert.normal = vert.normal
+            # Source loop indices of every corner in the chunk
+            loops = np.repeat(loop_start[chunk_polys] - starts, totals) + np.arange(totals.sum())
 
-        split()
+            used, vertex_index = np.unique(loop_verts[loops], return_inverse=True)
 
-        for poly in me.polygons:
-            if poly.loop_total >= limit:
-                continue
+            out_me = bpy.data.meshes.new(ob.name)
+            out_ob = bpy.data.objects.new(ob.name, out_me)
+            out_ob.matrix_world = ob.matrix_world
+            context.scene.objects.link(out_ob)
 
-            if len(out_me.loops) + poly.loop_total > limit:
-                split()
+            for material in me.materials:
+                out_me.materials.append(material)
 
-            loop_start = len(out_me.loops)
-            out_me.loops.add(poly.loop_total)
+            out_me.vertices.add(len(used))
+            out_me.vertices.foreach_set("co", co[used].ravel())
 
-            out_me.polygons.add(1)
-            out_poly = out_me.polygons[-1]
+            out_me.loops.add(len(loops))
+            out_me.loops.foreach_set("vertex_index", vertex_index.astype(np.int32))
 
-            out_poly.loop_start = loop_start
-            out_poly.loop_total = poly.loop_total
-            out_poly.use_smooth = poly.use_smooth
+            out_me.polygons.add(len(chunk_polys))
+            out_me.polygons.foreach_set("loop_start", starts.astype(np.int32))
+            out_me.polygons.foreach_set("loop_total", totals)
+            out_me.polygons.foreach_set("use_smooth", use_smooth[chunk_polys])
+            out_me.polygons.foreach_set("material_index", material_index[chunk_polys])
 
-            for loop_index, out_loop_index in zip(poly.loop_indices, out_poly.loop_indices):
-                loop = me.loops[loop_index]
-                out_loop = out_me.loops[out_loop_index]
+            for name, uvs in uv_layers:
+                out_me.uv_textures.new(name)
+                out_me.uv_layers[name].data.foreach_set("uv", uvs[loops].ravel())
 
-                out_loop.normal = loop.normal
-                out_loop.vertex_index = loop.vertex_index
+            out_me.validate()
+            out_me.update(calc_edges=True)
 
-        out_me.validate()
-        out_me.update()
+        if skipped:
+            self.report({"WARNING"}, "Skipped {} polygons larger than the limit".format(skipped))
 
         return {"FINISHED"}
 
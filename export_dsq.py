@@ -6,8 +6,9 @@ from itertools import groupby
 from .DsqFile import DsqFile
 from .DtsTypes import *
 from .util import fail, evaluate_all, find_reference, array_from_fcurves, \
-    array_from_fcurves_rotation, fcurves_keyframe_in_range, find_reference
-from .shared_export import find_seqs
+    array_from_fcurves_rotation, KeyframeCache, find_reference
+from .shared_export import find_seqs, sequence_frame_range, sample_transform, SampleStore, \
+    eliminate_constant_tracks, resample_tolerances, resample_tracks
 
 def save(operator, context, filepath,
          select_marker=False,
@@ -80,6 +81,15 @@ def save(operator, context, filepath,
                 auto_root_index = len(dsq.nodes)
                 dsq.nodes.append("__auto_root__")
 
+    # Every frame is sampled at most once, however many sequences use it
+    store = SampleStore(scene, animated_nodes, *sequence_frame_range(sequences))
+
+    constant_tracks = 0
+    constant_keys = 0
+
+    # Keyframe frames of each curve, shared by every sequence
+    keyframes = KeyframeCache()
+
     for name, markers in sequences.items():
         print("Exporting sequence", name)
 
@@ -101,6 +111,8 @@ def save(operator, context, filepath,
         seq.toolBegin = frame_start
         seq.duration = frame_range * (context.scene.render.fps_base / context.scene.render.fps)
 
+        resample = None
+
         if name in sequence_flags:
             for part in sequence_flags[name]:
                 flag, *data = part.split(" ", 1)
@@ -114,6 +126,8 @@ def save(operator, context, filepath,
                     seq.flags |= Sequence.Blend
                 elif flag == "duration":
                     seq.duration = float(data)
+                elif flag == "resample":
+                    resample = resample_tolerances(data)
                 else:
                     print("Warning: Unknown flag '{}' (used by sequence '{}')".format(flag, name))
 
@@ -137,16 +151,10 @@ def save(operator, context, filepath,
 
         dsq.sequences.append(seq)
 
-        frame_indices = list(range(frame_start, frame_end + 1))
-
-        # Store all animation data so we don't need to frame_set all over the place
-        animation_data = {frame: {} for frame in frame_indices}
+        samples = store.sample(frame_start, frame_end)
 
-        for frame in frame_indices:
-            scene.frame_set(frame)
-
-            for ob in animated_nodes:
-                animation_data[frame][ob] = ob.matrix_local.decompose()
+        tracks = []
+        bases = []
 
         for ob in animated_nodes:
             index = node_index[ob]
@@ -160,19 +168,35 @@ def save(operator, context, filepath,
             curves_scale = array_from_fcurves(fcurves, "scale", 3)
 
             # Decide what matters by presence of f-curves
-            if curves_rotation and fcurves_keyframe_in_range(curves_rotation, frame_start, frame_end):
+            if curves_rotation and keyframes.in_range(curves_rotation, frame_start, frame_end):
                 seq.rotationMatters[index] = True
 
-            if curves_translation and fcurves_keyframe_in_range(curves_translation, frame_start, frame_end):
+            if curves_translation and keyframes.in_range(curves_translation, frame_start, frame_end):
                 seq.translationMatters[index] = True
 
-            if curves_scale and fcurves_keyframe_in_range(curves_scale, frame_start, frame_end):
+            if curves_scale and keyframes.in_range(curves_scale, frame_start, frame_end):
                 seq.scaleMatters[index] = True
 
-            # Write the data where it matters
-            # This assumes that animated_nodes is in the same order as shape.nodes
-            for frame in frame_indices:
-                translation, rotation, scale = animation_data[frame][ob]
+            # Drop tracks that stay at the pose the node would have anyway
+            track = samples[:, store.columns[ob]]
+            cleared = eliminate_constant_tracks(seq, index, track, base_translation, base_rotation)
+            constant_tracks += cleared
+            constant_keys += cleared * seq.numKeyframes
+
+            tracks.append((index, track))
+            bases.append((base_translation, base_rotation))
+
+        # Fewer, further apart keyframes where the motion allows it
+        if resample is not None:
+            resampled = resample_tracks(seq, tracks, *resample)
+        else:
+            resampled = [track for _, track in tracks]
+
+        # Write the data where it matters
+        # This assumes that animated_nodes is in the same order as shape.nodes
+        for (index, _), track, (base_translation, base_rotation) in zip(tracks, resampled, bases):
+            for row in track.tolist():
+                translation, rotation, scale = sample_transform(row)
 
                 if seq.translationMatters[index]:
                     if seq.flags & Sequence.Blend:
@@ -187,6 +211,9 @@ def save(operator, context, filepath,
                 if seq.scaleMatters[index]:
                     dsq.aligned_scales.append(scale)
 
+    if constant_tracks:
+        print("Removed {} constant tracks, saving {} keys".format(constant_tracks, constant_keys))
+
     with open(filepath, "wb") as fd:
         dsq.write(fd)
 
@@ -1,14 +1,18 @@
-import bpy, bmesh, os, sys
+import bpy, bmesh, os, sys, time
+import numpy as np
 from math import sqrt, pi
 from operator import attrgetter
-from itertools import groupby
 
 from .DtsShape import DtsShape
 from .DtsTypes import *
+from .geometry import Geometry, normalized, transform_points, material_groups, sort_by_material, \
+    weld, stripify, optimize_vertex_cache, split_geometry, point_bounds, \
+    bounding_sphere, split_bone_palettes, merge_geometries, cull_triangles, decimate
 from .write_report import write_debug_report
 from .util import fail, resolve_texture, default_materials, evaluate_all, find_reference, \
-    array_from_fcurves, array_from_fcurves_rotation, fcurves_keyframe_in_range
-from .shared_export import find_seqs
+    array_from_fcurves, array_from_fcurves_rotation, KeyframeCache
+from .shared_export import find_seqs, sequence_frame_range, sample_transform, SampleStore, \
+    eliminate_constant_tracks, resample_tolerances, resample_tracks
 
 import re
 # re really isn't necessary. oh well.
@@ -27,12 +31,13 @@ def linearrgb_to_srgb(c):
     else:
         return 1.055 * (c ** (1.0 / 2.4)) - 0.055
 
-def get_vertex_bone(mesh, node):
-    for bone_index, (node_index, _) in enumerate(mesh.bones):
-        if node_index == node.index:
-            return bone_index
+def get_vertex_bone(mesh, node, bone_indices):
+    bone_index = bone_indices.get(node.index)
 
-    bone_index = len(mesh.bones)
+    if bone_index is not None:
+        return bone_index
+
+    bone_index = bone_indices[node.index] = len(mesh.bones)
     mat = node.bl_ob.matrix_local
 
     # TODO: Move this conversion to DtsTypes.py
@@ -41,34 +46,258 @@ def get_vertex_bone(mesh, node):
     mesh.bones.append((node.index, flat_mat))
     return bone_index
 
-def add_vertex_influences(ob, armature, node_lookup, mesh, vert, vertex_index):
-    influences = []
-    total_weight = 0
+def limit_influences(weights, max_influences=0, min_weight=0.0, weight_steps=0):
+    """Cap, prune and quantize normalized (node, weight) pairs, keeping them normalized"""
+    weights = sorted(weights, key=lambda influence: influence[1], reverse=True)
+
+    if max_influences:
+        weights = weights[:max_influences]
+
+    # The strongest weight always stays, even when it is below the threshold
+    weights = weights[:1] + [influence for influence in weights[1:] if influence[1] >= min_weight]
+
+    total_weight = sum(weight for _, weight in weights)
+
+    if total_weight == 0:
+        return weights
+
+    weights = [(node, weight / total_weight) for node, weight in weights]
+
+    if weight_steps:
+        # Round down, then hand the missing steps to the largest remainders
+        steps = [int(weight * weight_steps) for _, weight in weights]
+        remainders = sorted(range(len(weights)),
+                            key=lambda i: weights[i][1] * weight_steps - steps[i], reverse=True)
+
+        for i in remainders[:weight_steps - sum(steps)]:
+            steps[i] += 1
+
+        weights = [(node, step / weight_steps) for (node, _), step in zip(weights, steps) if step]
+
+    return weights
+
+def vertex_influences(ob, armature, vertex_groups, node_lookup, max_influences=0, min_weight=0.0, weight_steps=0):
+    """Resolve the vertex groups of every source vertex into normalized (node, weight) lists.
 
-    for group in vert.groups:
-        vertex_group = ob.vertex_groups[group.group]
+    Returns the influences along with how many each vertex had before limiting.
+    """
+    group_nodes = []
 
+    for vertex_group in ob.vertex_groups:
         bone = armature.data.bones.get(vertex_group.name)
-        if bone is None:
-            continue
+        node = node_lookup.get(bone) if bone is not None else None
+        group_nodes.append(node if node is not False else None)
 
-        node = node_lookup.get(bone)
-        if node is False:
-            continue
+    influences = []
+    counts = []
 
-        influences.append((node, group.weight))
-        total_weight += group.weight
+    for groups in vertex_groups:
+        weights = [(group_nodes[group], weight) for group, weight in groups
+                   if group_nodes[group] is not None]
+        total_weight = sum(weight for _, weight in weights)
 
-    if total_weight == 0:
-        weight_multiplier = 1
+        if total_weight == 0:
+            weight_multiplier = 1
+        else:
+            weight_multiplier = 1 / total_weight
+
+        weights = [(node, weight * weight_multiplier) for node, weight in weights]
+        counts.append(len(weights))
+
+        if weights:
+            weights = limit_influences(weights, max_influences, min_weight, weight_steps)
+
+        influences.append(weights)
+
+    return influences, counts
+
+def split_palettes(pieces, skin, max_bones):
+    influences, _ = skin
+    palette_pieces = []
+
+    for geom in pieces:
+        vertex_bones = [{node.index for node, _ in influences[vert_index]}
+                        for vert_index in geom.source.tolist()]
+        palette_pieces.extend(split_bone_palettes(geom, vertex_bones, max_bones))
+
+    if len(palette_pieces) > len(pieces):
+        print("  Split into {} pieces of at most {} bones".format(len(palette_pieces), max_bones))
+
+    return palette_pieces
+
+def add_vertex_influences(mesh, source, skin):
+    # Exported vertices share the cached influences of the vertex they came from
+    influences, counts = skin
+    bone_indices = {}
+
+    mesh.unlimited_influences = sum(counts[vert_index] for vert_index in source)
+
+    for vertex_index, vert_index in enumerate(source):
+        for node, weight in influences[vert_index]:
+            mesh.influences.append((
+                vertex_index,
+                get_vertex_bone(mesh, node, bone_indices),
+                weight))
+
+def extract_geometry(mesh, transform_mat):
+    num_verts = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    num_polys = len(mesh.polygons)
+
+    co = np.empty(num_verts * 3, dtype=np.float32)
+    vert_normals = np.empty(num_verts * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    mesh.vertices.foreach_get("normal", vert_normals)
+
+    loop_verts = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+
+    loop_start = np.empty(num_polys, dtype=np.int32)
+    poly_normals = np.empty(num_polys * 3, dtype=np.float32)
+    poly_smooth = np.empty(num_polys, dtype=bool)
+    poly_materials = np.empty(num_polys, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    mesh.polygons.foreach_get("normal", poly_normals)
+    mesh.polygons.foreach_get("use_smooth", poly_smooth)
+    mesh.polygons.foreach_get("material_index", poly_materials)
+
+    co.shape = (-1, 3)
+    vert_normals.shape = (-1, 3)
+    poly_normals.shape = (-1, 3)
+
+    # Group triangles by material, keeping polygon order within a group
+    polys = np.argsort(poly_materials, kind="mergesort")
+
+    # The mesh is triangulated, so each polygon has three loops. Their order
+    # is reversed to flip the winding for Torque.
+    loops = (loop_start[polys][:, None] + np.array((2, 1, 0))).ravel()
+    source = loop_verts[loops]
+
+    mat = np.array(transform_mat, dtype=np.float64)
+
+    verts = transform_points(mat, co[source])
+
+    smooth = np.repeat(poly_smooth[polys], 3)
+    normals = np.where(smooth[:, None],
+        vert_normals[source],
+        np.repeat(poly_normals[polys], 3, axis=0))
+    normals = normalized(normals.dot(mat[:3, :3].T))
+
+    if mesh.uv_layers:
+        uvs = np.empty(num_loops * 2, dtype=np.float32)
+        mesh.uv_layers[0].data.foreach_get("uv", uvs)
+        uvs.shape = (-1, 2)
+        tverts = uvs[loops]
+        tverts[:, 1] = 1 - tverts[:, 1]
+    else:
+        tverts = np.zeros((len(loops), 2), dtype=np.float32)
+
+    # Every loop becomes its own vertex for now
+    tris = np.arange(len(loops), dtype=np.int64).reshape(-1, 3)
+
+    return Geometry(
+        verts.astype(np.float32), normals.astype(np.float32), tverts,
+        tris, poly_materials[polys], source)
+
+def export_mesh(scene, lod, material_flags, apply_modifiers):
+    bobj, transform_mat, armature_modifier = lod
+
+    if armature_modifier is None:
+        mesh_type = Mesh.StandardType
     else:
-        weight_multiplier = 1 / total_weight
+        mesh_type = Mesh.SkinType
+
+    #########################
+    ### Welcome to complexity
+
+    # Disable the armature modifier so it does not deform the mesh
+    # when writing it to the DTS file
+    if armature_modifier is not None:
+        was_show_render = armature_modifier.show_render
+        was_show_viewport = armature_modifier.show_viewport
+
+        armature_modifier.show_render = False
+        armature_modifier.show_viewport = False
+
+    mesh = bobj.to_mesh(scene, apply_modifiers, "PREVIEW")
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bmesh.ops.triangulate(bm, faces=bm.faces)
+    bm.to_mesh(mesh)
+    bm.free()
+
+    # Restore the armature modifier
+    if armature_modifier is not None:
+        armature_modifier.show_render = was_show_render
+        armature_modifier.show_viewport = was_show_viewport
 
-    for node, weight in influences:
-        mesh.influences.append((
-            vertex_index,
-            get_vertex_bone(mesh, node),
-            weight * weight_multiplier))
+    # This is the danger zone
+    # Data from down here may not stay around!
+
+    geom = extract_geometry(mesh, transform_mat)
+
+    # Map every used material slot to its primitive flags
+    slot_flags = {}
+
+    for material_index in np.unique(geom.materials).tolist():
+        if mesh.materials:
+            slot_flags[material_index] = material_flags(mesh.materials[material_index])
+        else:
+            slot_flags[material_index] = material_flags(None)
+
+    flags_lookup = np.zeros(max(slot_flags, default=0) + 1, dtype=np.int64)
+    flags_lookup[list(slot_flags)] = list(slot_flags.values())
+    geom.materials = flags_lookup[geom.materials]
+
+    if mesh_type == Mesh.SkinType:
+        vertex_groups = [[(group.group, group.weight) for group in vert.groups]
+                         for vert in mesh.vertices]
+        skin = (bobj, armature_modifier.object, vertex_groups)
+    else:
+        skin = None
+
+    bpy.data.meshes.remove(mesh) # RIP!
+
+    ### Nobody leaves Hotel California
+
+    num_loops = len(geom.verts)
+    geom = weld(geom, mesh_type == Mesh.SkinType)
+    print("  Welded {} loops into {} vertices".format(num_loops, len(geom.verts)))
+
+    geom, num_degenerate, num_duplicate = cull_triangles(geom)
+
+    if num_degenerate or num_duplicate:
+        print("  Removed {} degenerate and {} duplicate triangles".format(num_degenerate, num_duplicate))
+
+    return mesh_type, geom, skin
+
+def write_geometry(dmesh, geom, use_strips=False):
+    sort_by_material(geom)
+
+    dmesh.verts = list(map(Vector, geom.verts.tolist()))
+    dmesh.verts_array = geom.verts
+    dmesh.normals = list(map(Vector, geom.normals.tolist()))
+    dmesh.tverts = list(map(Vector, geom.tverts.tolist()))
+    dmesh.enormals = [0] * len(geom.verts)
+    dmesh.indices = []
+
+    # Create a primitive from each material group
+    for flags, first, end in material_groups(geom.materials):
+        tris = geom.tris[first:end]
+        firstElement = len(dmesh.indices)
+
+        if use_strips:
+            strip = stripify(tris)
+
+            # Only use the strip when it is actually smaller than the list
+            if len(strip) < tris.size:
+                flags = (flags & ~Primitive.TypeMask) | Primitive.Strip
+                dmesh.indices.extend(strip)
+                dmesh.primitives.append(Primitive(firstElement, len(strip), flags))
+                continue
+
+        dmesh.indices.extend(tris.ravel().tolist())
+        dmesh.primitives.append(Primitive(firstElement, tris.size, flags))
 
 def export_material(mat, shape):
     # print("Exporting material", mat.name)
@@ -131,7 +360,7 @@ def export_empty_node(lookup, shape, select_object, ob, parent=-1):
 
     node.armature = None
     node.bl_ob = ob
-    node.matrix = ob.matrix_local
+    node.matrix = ob.matrix_local.copy()
 
     shape.nodes.append(node)
     lookup[ob] = node
@@ -344,12 +573,102 @@ def save_meshes(scene, shape, node_lookup, select_object):
         if lod_name in scene_objects[name][1]:
             print("Warning: Multiple objects {} in LOD {}, ignoring...".format(name, lod_name))
         else:
-            scene_objects[name][1][lod_name] = (bobj, transform_mat, armature_modifier)
+            scene_objects[name][1][lod_name] = [(bobj, transform_mat, armature_modifier)]
 
     return scene_lods, scene_objects, bounds_ob
 
+def is_static_object(bobj, armature_modifier):
+    if armature_modifier is not None:
+        return False
+
+    data = bobj.animation_data
+
+    if data and data.action:
+        for curve in data.action.fcurves:
+            if curve.data_path in ("hide", "hide_render"):
+                return False
+
+    return True
+
+def merge_static_objects(shape, scene_objects):
+    """Combine static objects attached to the same node into one object.
+
+    Their meshes are merged per LOD, so every material ends up in a single
+    primitive instead of one per Blender object.
+    """
+    groups = {}
+
+    for name, (object, lods) in scene_objects.items():
+        if all(is_static_object(bobj, armature_modifier)
+               for entries in lods.values()
+               for bobj, _, armature_modifier in entries):
+            groups.setdefault((object.node, object.has_transparency), []).append(name)
+
+    for names in groups.values():
+        if len(names) < 2:
+            continue
+
+        target, target_lods = scene_objects[names[0]]
+
+        for name in names[1:]:
+            object, lods = scene_objects.pop(name)
+
+            for lod_name, entries in lods.items():
+                target_lods.setdefault(lod_name, []).extend(entries)
+
+            index = shape.objects.index(object)
+            del shape.objects[index]
+            del shape.objectstates[index]
+
+        print("Merged {} static objects into '{}'".format(len(names), shape.names[target.name]))
+
+def add_generated_lods(shape, generate_lods):
+    """Add the detail levels listed as "size:ratio, ..." to be generated by decimation.
+
+    Returns {LOD name index: triangle ratio}.
+    """
+    generated = {}
+
+    if not any(lod.size >= 0 for lod in shape.detail_levels):
+        return generated
+
+    sizes = {lod.size for lod in shape.detail_levels}
+
+    for part in generate_lods.split(","):
+        if not part.strip():
+            continue
+
+        try:
+            size, ratio = part.split(":")
+            size, ratio = int(size), float(ratio)
+        except ValueError:
+            print("Warning: Invalid generated LOD '{}', expected size:ratio".format(part.strip()))
+            continue
+
+        if size in sizes:
+            print("Warning: There already is a LOD of size {}, not generating one".format(size))
+            continue
+
+        print("Creating generated LOD 'detail{}' (size {}, {:.0%} of the triangles)".format(size, size, ratio))
+        lod = DetailLevel(name=shape.name("detail{}".format(size)), subshape=0, objectDetail=-1, size=size)
+        shape.detail_levels.append(lod)
+        sizes.add(size)
+        generated[lod.name] = ratio
+
+    return generated
+
+def mesh_points(mesh):
+    # Meshes written by this exporter keep their vertex array around
+    points = getattr(mesh, "verts_array", None)
+
+    if points is None:
+        points = np.array([tuple(vert) for vert in mesh.verts], dtype=np.float64)
+
+    return points.reshape(-1, 3)
+
 def compute_bounds(shape, bounds_ob):
     print("Computing bounds")
+    start_time = time.perf_counter()
 
     # shape.smallest_size = None
     # shape.smallest_detail_level = -1
@@ -359,43 +678,162 @@ def compute_bounds(shape, bounds_ob):
     #         shape.smallest_size = lod.size
     #         shape.smallest_detail_level = i
 
-    shape.bounds = Box(
-        Vector(( 10e30,  10e30,  10e30)),
-        Vector((-10e30, -10e30, -10e30)))
-
-    shape.center = Vector()
-
-    shape.radius = 0
-    shape.radius_tube = 0
+    # Transform every mesh into shape space once and reduce them together
+    points = []
 
     for obj in shape.objects:
+        mat = shape.nodes[obj.node].matrix_world
+
         for j in range(0, obj.numMeshes):
             mesh = shape.meshes[obj.firstMesh + j]
 
             if mesh.type == Mesh.NullType:
                 continue
 
-            mat = shape.nodes[obj.node].matrix_world
-            bounds = mesh.calculate_bounds_mat(mat)
+            points.append(transform_points(mat, mesh_points(mesh)))
 
-            shape.radius = max(shape.radius, mesh.calculate_radius_mat(mat, shape.center))
-            shape.radius_tube = max(shape.radius_tube, mesh.calculate_radius_tube_mat(mat, shape.center))
+    if points:
+        points = np.concatenate(points)
+    else:
+        points = np.zeros((0, 3))
 
-            shape.bounds.min.x = min(shape.bounds.min.x, bounds.min.x)
-            shape.bounds.min.y = min(shape.bounds.min.y, bounds.min.y)
-            shape.bounds.min.z = min(shape.bounds.min.z, bounds.min.z)
-            shape.bounds.max.x = max(shape.bounds.max.x, bounds.max.x)
-            shape.bounds.max.y = max(shape.bounds.max.y, bounds.max.y)
-            shape.bounds.max.z = max(shape.bounds.max.z, bounds.max.z)
+    bounds_min, bounds_max, _, _ = point_bounds(points)
+
+    if len(points):
+        shape.bounds = Box(Vector(bounds_min.tolist()), Vector(bounds_max.tolist()))
+    else:
+        shape.bounds = Box(
+            Vector(( 10e30,  10e30,  10e30)),
+            Vector((-10e30, -10e30, -10e30)))
 
     # Is there a bounds mesh? Use that instead.
     if bounds_ob:
       shape.bounds = Box(Vector(bounds_ob.bound_box[0]), Vector(bounds_ob.bound_box[6]))
 
-    shape.center = Vector((
-        (shape.bounds.min.x + shape.bounds.max.x) / 2,
-        (shape.bounds.min.y + shape.bounds.max.y) / 2,
-        (shape.bounds.min.z + shape.bounds.max.z) / 2))
+    if len(points):
+        # The radii are measured around the tightest sphere, not the box
+        center, shape.radius = bounding_sphere(points)
+        shape.radius_tube = point_bounds(points, center)[3]
+        shape.center = Vector(center.tolist())
+    else:
+        shape.center = Vector((
+            (shape.bounds.min.x + shape.bounds.max.x) / 2,
+            (shape.bounds.min.y + shape.bounds.max.y) / 2,
+            (shape.bounds.min.z + shape.bounds.max.z) / 2))
+        shape.radius = 0
+        shape.radius_tube = 0
+
+    print("  bounds took {:.1f} ms".format((time.perf_counter() - start_time) * 1000))
+
+# Node names the engine looks up by name, kept even when nothing uses them
+re_protected_node = re.compile(
+    r"^(eye|cam|ear|mount\d+|muzzlepoint\d*|ejectpoint\d*|retractionpoint\d*|"
+    r"jetnozzle\d*|contrail\d*|hub\d+|wheel\d*|start\d*|end\d*)$", re.IGNORECASE)
+
+def protected_node_names():
+    names = set()
+
+    if "ProtectedNodes" in bpy.data.texts:
+        for line in bpy.data.texts["ProtectedNodes"].as_string().split("\n"):
+            if line.strip():
+                names.add(line.strip().lower())
+
+    return names
+
+def fold_node(shape, node_index, child_index):
+    """Move the default transform of a node into its child, including its animation"""
+    translation = shape.default_translations[node_index]
+    rotation = shape.default_rotations[node_index]
+
+    shape.default_translations[child_index] = translation + rotation * shape.default_translations[child_index]
+    shape.default_rotations[child_index] = rotation * shape.default_rotations[child_index]
+
+    for seq in shape.sequences:
+        is_blend = seq.flags & Sequence.Blend
+
+        if seq.translationMatters[child_index]:
+            first = seq.baseTranslation + sum(seq.translationMatters[:child_index]) * seq.numKeyframes
+
+            for key in range(first, first + seq.numKeyframes):
+                if is_blend:
+                    shape.node_translations[key] = rotation * shape.node_translations[key]
+                else:
+                    shape.node_translations[key] = translation + rotation * shape.node_translations[key]
+
+        # Blend rotations are relative to the default rotation, which moved along
+        if seq.rotationMatters[child_index] and not is_blend:
+            first = seq.baseRotation + sum(seq.rotationMatters[:child_index]) * seq.numKeyframes
+
+            for key in range(first, first + seq.numKeyframes):
+                shape.node_rotations[key] = rotation * shape.node_rotations[key]
+
+    shape.nodes[child_index].parent = shape.nodes[node_index].parent
+
+def prune_nodes(shape):
+    """Remove nodes with nothing attached, no animation and no required name.
+
+    Their transforms are folded into their children, and every reference to
+    node indices is remapped.
+    """
+    protected = protected_node_names()
+    used = {obj.node for obj in shape.objects}
+
+    for mesh in shape.meshes:
+        if mesh.get_type() == Mesh.SkinType:
+            used.update(node_index for node_index, _ in mesh.bones)
+
+    # Only the transform bitsets are indexed by node; the others are per
+    # object, IFL material or decal and are left alone
+    for seq in shape.sequences:
+        for matters in (seq.rotationMatters, seq.translationMatters, seq.scaleMatters):
+            used.update(index for index, bit in enumerate(matters) if bit)
+
+    pruned = []
+
+    for index, node in enumerate(shape.nodes):
+        name = shape.names[node.name]
+
+        if index in used or re_protected_node.match(name) or name.lower() in protected:
+            continue
+
+        for child_index, child in enumerate(shape.nodes):
+            if child.parent == index:
+                fold_node(shape, index, child_index)
+
+        pruned.append(index)
+
+    if not pruned:
+        return
+
+    pruned = set(pruned)
+    keep = [index for index in range(len(shape.nodes)) if index not in pruned]
+    remap = {old: new for new, old in enumerate(keep)}
+    remap[-1] = -1
+
+    shape.nodes = [shape.nodes[index] for index in keep]
+    shape.default_translations = [shape.default_translations[index] for index in keep]
+    shape.default_rotations = [shape.default_rotations[index] for index in keep]
+
+    for index, node in enumerate(shape.nodes):
+        node.parent = remap[node.parent]
+        node.index = index
+
+    for obj in shape.objects:
+        obj.node = remap[obj.node]
+
+    for mesh in shape.meshes:
+        if mesh.get_type() == Mesh.SkinType:
+            mesh.bones = [(remap[node_index], mat) for node_index, mat in mesh.bones]
+
+    for seq in shape.sequences:
+        for attr in ("rotationMatters", "translationMatters", "scaleMatters"):
+            matters = getattr(seq, attr)
+            setattr(seq, attr, [matters[index] for index in keep])
+
+    for subshape in shape.subshapes:
+        subshape.numNodes = len(shape.nodes)
+
+    print("Pruned {} unused nodes".format(len(pruned)))
 
 def save(operator, context, filepath,
          select_object=False,
@@ -405,6 +843,15 @@ def save(operator, context, filepath,
          raw_colors = False,
          dsq_compat = False,
          apply_modifiers=True,
+         use_strips=False,
+         optimize_cache=False,
+         max_influences=0,
+         min_weight=0.0,
+         weight_steps=0,
+         max_bones=0,
+         prune_unused_nodes=False,
+         merge_static=False,
+         generate_lods="",
          debug_report=False):
     print("Exporting scene to DTS")
 
@@ -426,16 +873,16 @@ def save(operator, context, filepath,
     scene_lods, scene_objects, bounds_ob = save_meshes(
         scene, shape, node_lookup, select_object)
 
+    if merge_static:
+        merge_static_objects(shape, scene_objects)
+
+    generated_lods = add_generated_lods(shape, generate_lods)
+
     # If the shape is empty, add a detail level so it is valid
     if not shape.detail_levels:
         dl = DetailLevel(name=shape.name('detail1'), subshape=0, objectDetail=-1, size=1)
         shape.detail_levels.append(dl)
 
-    # Put objects with transparent materials last
-    # Note: If this plugin ever needs to do anything with objectstates,
-    #       that needs to be handled properly. a37hm: earch for ff56g
-    shape.objects.sort(key=lambda object: object.has_transparency) # TODO: attrgetter
-
     # Sort detail levels
     shape.detail_levels.sort(key=attrgetter("size"), reverse=True)
 
@@ -446,149 +893,137 @@ def save(operator, context, filepath,
 
     material_table = {}
 
-    for object, lods in scene_objects.values():
-        object.firstMesh = len(shape.meshes)
+    def material_flags(bmat):
+        nonlocal blank_material_index
 
-        for i, lod in enumerate(reversed(shape.detail_levels)):
-            if shape.names[lod.name] in lods:
-                object.numMeshes = len(shape.detail_levels) - i
-                break
-        else:
-            object.numMeshes = 0
-            continue
+        flags = Primitive.Triangles | Primitive.Indexed
 
-        for i in range(object.numMeshes):
-            lod = shape.detail_levels[i]
-            lod_name = shape.names[lod.name]
+        if bmat is not None:
+            if bmat not in material_table:
+                material_table[bmat] = export_material(bmat, shape)
 
-            if lod_name in lods:
-                print("Exporting mesh '{}' (LOD '{}')".format(shape.names[object.name], lod_name))
-                bobj, transform_mat, armature_modifier = lods[lod_name]
-
-                if armature_modifier is None:
-                    mesh_type = Mesh.StandardType
-                else:
-                    mesh_type = Mesh.SkinType
-                    armature = armature_modifier.object
+            flags |= material_table[bmat] & Primitive.MaterialMask
+        elif blank_material:
+            if blank_material_index is None:
+                blank_material_index = len(shape.materials)
+                shape.materials.append(Material(name="blank",
+                    flags=Material.SWrap | Material.TWrap | Material.NeverEnvMap))
 
-                #########################
-                ### Welcome to complexity
+            flags |= blank_material_index & Primitive.MaterialMask
+        else:
+            flags |= Primitive.NoMaterial
 
-                # Disable the armature modifier so it does not deform the mesh
-                # when writing it to the DTS file
-                if armature_modifier is not None:
-                    was_show_render = armature_modifier.show_render
-                    was_show_viewport = armature_modifier.show_viewport
+        return flags
 
-                    armature_modifier.show_render = False
-                    armature_modifier.show_viewport = False
+    for object, lods in tuple(scene_objects.values()):
+        lod_geoms = {}
 
-                mesh = bobj.to_mesh(scene, apply_modifiers, "PREVIEW")
-                bm = bmesh.new()
-                bm.from_mesh(mesh)
-                bmesh.ops.triangulate(bm, faces=bm.faces)
-                bm.to_mesh(mesh)
-                bm.free()
+        for i, lod in enumerate(shape.detail_levels):
+            lod_name = shape.names[lod.name]
 
-                # Restore the armature modifier
-                if armature_modifier is not None:
-                    armature_modifier.show_render = was_show_render
-                    armature_modifier.show_viewport = was_show_viewport
+            if lod_name in lods:
+                print("Exporting mesh '{}' (LOD '{}')".format(shape.names[object.name], lod_name))
+                meshes = [export_mesh(scene, entry, material_flags, apply_modifiers)
+                          for entry in lods[lod_name]]
+                mesh_type, geom, skin = meshes[0]
 
-                # This is the danger zone
-                # Data from down here may not stay around!
+                if len(meshes) > 1:
+                    geom = merge_geometries([geom for _, geom, _ in meshes])
 
-                dmesh = Mesh(mesh_type)
-                shape.meshes.append(dmesh)
+                lod_geoms[i] = mesh_type, geom, skin
 
-                dmesh.matrix_world = bobj.matrix_world
+        # Generated LODs are decimated from the most detailed visible mesh
+        source = next((i for i in sorted(lod_geoms) if shape.detail_levels[i].size >= 0), None)
 
-                dmesh.bounds = dmesh.calculate_bounds_mat(Matrix())
-                #dmesh.center = Vector((
-                #    (dmesh.bounds.min.x + dmesh.bounds.max.x) / 2,
-                #    (dmesh.bounds.min.y + dmesh.bounds.max.y) / 2,
-                #    (dmesh.bounds.min.z + dmesh.bounds.max.z) / 2))
-                dmesh.center = Vector()
-                dmesh.radius = dmesh.calculate_radius_mat(Matrix(), dmesh.center)
+        if generated_lods and source is not None:
+            mesh_type, geom, skin = lod_geoms[source]
 
-                # Group all materials by their material_index
-                key = attrgetter("material_index")
-                grouped_polys = groupby(sorted(mesh.polygons, key=key), key=key)
-                grouped_polys = tuple(map(lambda t: (t[0], tuple(t[1])), grouped_polys))
+            for i, lod in enumerate(shape.detail_levels):
+                ratio = generated_lods.get(lod.name)
 
-                # Create a primitive from each group
-                for material_index, polys in grouped_polys:
-                    flags = Primitive.Triangles | Primitive.Indexed
+                if ratio is not None:
+                    decimated = decimate(geom, int(len(geom.tris) * ratio))
+                    print("Generated mesh '{}' (LOD '{}') with {} of {} triangles".format(
+                        shape.names[object.name], shape.names[lod.name], len(decimated.tris), len(geom.tris)))
+                    lod_geoms[i] = mesh_type, decimated, skin
 
-                    if mesh.materials:
-                        bmat = mesh.materials[material_index]
+        # Meshes of every LOD this object has, split into pieces that each
+        # fit the 16-bit index limit
+        lod_meshes = {}
 
-                        if bmat not in material_table:
-                            material_table[bmat] = export_material(bmat, shape)
+        for i, (mesh_type, geom, skin) in lod_geoms.items():
+            pieces = split_geometry(geom)
 
-                        flags |= material_table[bmat] & Primitive.MaterialMask
-                    elif blank_material:
-                        if blank_material_index is None:
-                            blank_material_index = len(shape.materials)
-                            shape.materials.append(Material(name="blank",
-                                flags=Material.SWrap | Material.TWrap | Material.NeverEnvMap))
+            if skin is not None:
+                skin_ob, armature, vertex_groups = skin
+                skin = vertex_influences(skin_ob, armature, vertex_groups, node_lookup,
+                                         max_influences, min_weight, weight_steps)
 
-                        flags |= blank_material_index & Primitive.MaterialMask
-                    else:
-                        flags |= Primitive.NoMaterial
+                if max_bones:
+                    pieces = split_palettes(pieces, skin, max_bones)
 
-                    firstElement = len(dmesh.verts)
+            lod_meshes[i] = mesh_type, pieces, skin
 
-                    for poly in polys:
-                        if mesh.uv_layers:
-                            uv_layer = mesh.uv_layers[0].data
-                        else:
-                            uv_layer = None
+        num_pieces = max((len(pieces) for _, pieces, _ in lod_meshes.values()), default=1)
+        piece_objects = [object]
 
-                        use_face_normal = not poly.use_smooth
+        if num_pieces > 1:
+            print("  Splitting '{}' into {} objects to fit index and bone limits"
+                  .format(shape.names[object.name], num_pieces))
 
-                        for vert_index, loop_index in zip(reversed(poly.vertices), reversed(poly.loop_indices)):
-                            vertex_index = len(dmesh.verts)
-                            dmesh.indices.append(len(dmesh.indices))
+        for piece in range(1, num_pieces):
+            name = "{}_{}".format(shape.names[object.name], piece + 1)
+            piece_object = Object(shape.name(name), numMeshes=0, firstMesh=0, node=object.node)
+            piece_object.has_transparency = object.has_transparency
+            shape.objects.append(piece_object)
+            shape.objectstates.append(ObjectState(1.0, 0, 0)) # ff56g: search for a37hm
+            piece_objects.append(piece_object)
 
-                            vert = mesh.vertices[vert_index]
+        for piece, piece_object in enumerate(piece_objects):
+            piece_object.firstMesh = len(shape.meshes)
+            piece_object.numMeshes = 0
 
-                            if use_face_normal:
-                                normal = poly.normal
-                            else:
-                                normal = vert.normal
+            for i, (_, pieces, _) in lod_meshes.items():
+                if piece < len(pieces):
+                    piece_object.numMeshes = max(piece_object.numMeshes, i + 1)
 
-                            dmesh.verts.append(transform_mat * vert.co)
-                            dmesh.normals.append((transform_mat.to_3x3() * normal).normalized())
+            for i in range(piece_object.numMeshes):
+                if i in lod_meshes and piece < len(lod_meshes[i][1]):
+                    mesh_type, pieces, skin = lod_meshes[i]
+                    geom = pieces[piece]
 
-                            dmesh.enormals.append(0)
+                    if optimize_cache:
+                        geom = optimize_vertex_cache(geom)
 
-                            if uv_layer:
-                                uv = uv_layer[loop_index].uv
-                                dmesh.tverts.append(Vector((uv.x, 1 - uv.y)))
-                            else:
-                                dmesh.tverts.append(Vector((0, 0)))
+                    dmesh = Mesh(mesh_type)
+                    shape.meshes.append(dmesh)
 
-                            if mesh_type == Mesh.SkinType:
-                                add_vertex_influences(bobj, armature,
-                                                      node_lookup, dmesh,
-                                                      vert, vertex_index)
+                    write_geometry(dmesh, geom, use_strips)
 
-                    numElements = len(dmesh.verts) - firstElement
-                    dmesh.primitives.append(Primitive(firstElement, numElements, flags))
+                    if mesh_type == Mesh.SkinType:
+                        add_vertex_influences(dmesh, geom.source.tolist(), skin)
 
-                bpy.data.meshes.remove(mesh) # RIP!
+                    bounds_min, bounds_max, dmesh.radius, _ = point_bounds(geom.verts)
+                    dmesh.bounds = Box(Vector(bounds_min.tolist()), Vector(bounds_max.tolist()))
+                    #dmesh.center = Vector((
+                    #    (dmesh.bounds.min.x + dmesh.bounds.max.x) / 2,
+                    #    (dmesh.bounds.min.y + dmesh.bounds.max.y) / 2,
+                    #    (dmesh.bounds.min.z + dmesh.bounds.max.z) / 2))
+                    dmesh.center = Vector()
 
-                # ??? ? ?? ???? ??? ?
-                dmesh.vertsPerFrame = len(dmesh.verts)
+                    # ??? ? ?? ???? ??? ?
+                    dmesh.vertsPerFrame = len(dmesh.verts)
 
-                if len(dmesh.indices) >= 65536:
-                    return fail(operator, "The mesh '{}' has too many vertex indices ({} >= 65536)".format(bobj.name, len(dmesh.indices)))
+                    if len(dmesh.indices) >= 65536:
+                        return fail(operator, "The mesh '{}' has too many vertex indices ({} >= 65536)".format(shape.names[piece_object.name], len(dmesh.indices)))
+                else:
+                    # print("Adding Null mesh for object {} in LOD {}".format(shape.names[piece_object.name], lod_name))
+                    shape.meshes.append(Mesh(Mesh.NullType))
 
-                ### Nobody leaves Hotel California
-            else:
-                # print("Adding Null mesh for object {} in LOD {}".format(shape.names[object.name], lod_name))
-                shape.meshes.append(Mesh(Mesh.NullType))
+    # Put objects with transparent materials last
+    # Note: If this plugin ever needs to do anything with objectstates,
+    #       that needs to be handled properly. a37hm: earch for ff56g
+    shape.objects.sort(key=lambda object: object.has_transparency) # TODO: attrgetter
 
     print("Creating subshape with " + str(len(shape.nodes)) + " nodes and " + str(len(shape.objects)) + " objects")
     shape.subshapes.append(Subshape(0, 0, 0, len(shape.nodes), len(shape.objects), 0))
@@ -598,6 +1033,27 @@ def save(operator, context, filepath,
 
     sequences, sequence_flags = find_seqs(context.scene, select_marker)
 
+    animated_nodes = []
+
+    for node in shape.nodes:
+        if node.armature is not None or node.bl_ob is None:
+            continue
+
+        data = node.bl_ob.animation_data
+
+        if data and data.action and len(data.action.fcurves):
+            animated_nodes.append(node)
+
+    # Every frame is sampled at most once, however many sequences use it
+    store = SampleStore(scene, [node.bl_ob for node in animated_nodes],
+                        *sequence_frame_range(sequences))
+
+    constant_tracks = 0
+    constant_keys = 0
+
+    # Keyframe frames of each curve, shared by every sequence
+    keyframes = KeyframeCache()
+
     for name, markers in sequences.items():
         print("Exporting sequence", name)
 
@@ -619,6 +1075,8 @@ def save(operator, context, filepath,
         seq.toolBegin = frame_start
         seq.duration = frame_range * (context.scene.render.fps_base / context.scene.render.fps)
 
+        resample = None
+
         if name in sequence_flags:
             for part in sequence_flags[name]:
                 flag, *data = part.split(" ", 1)
@@ -632,6 +1090,8 @@ def save(operator, context, filepath,
                     seq.flags |= Sequence.Blend
                 elif flag == "duration":
                     seq.duration = float(data)
+                elif flag == "resample":
+                    resample = resample_tolerances(data)
                 else:
                     print("Warning: Unknown flag '{}' (used by sequence '{}')".format(flag, name))
 
@@ -655,35 +1115,21 @@ def save(operator, context, filepath,
 
         shape.sequences.append(seq)
 
-        frame_indices = list(range(frame_start, frame_end + 1))
-
-        # Store all animation data so we don't need to frame_set all over the place
-        animation_data = {frame: {} for frame in frame_indices}
+        samples = store.sample(frame_start, frame_end)
 
-        for frame in frame_indices:
-            scene.frame_set(frame)
-
-            for node in shape.nodes:
-                if node.armature is not None:
-                    continue
-
-                animation_data[frame][node] = node.matrix.decompose()
-
-        for index, node in enumerate(shape.nodes):
-            if node.armature is not None:
-                continue
+        tracks = []
+        bases = []
 
+        for node in animated_nodes:
+            index = node.index
             ob = node.bl_ob
-
-            if ob is None:
-                continue
-
             data = ob.animation_data
 
-            if not data or not data.action or not len(data.action.fcurves):
-                continue
-
-            base_translation, base_rotation, _ = node.matrix.decompose()
+            # The default transform was captured at the reference frame. The
+            # scene frame here depends on which frames earlier sequences
+            # already sampled, so nothing is read from the live scene.
+            base_translation = shape.default_translations[index]
+            base_rotation = shape.default_rotations[index]
             base_scale = Vector((1.0, 1.0, 1.0))
 
             fcurves = data.action.fcurves
@@ -693,18 +1139,35 @@ def save(operator, context, filepath,
             curves_scale = array_from_fcurves(fcurves, "scale", 3)
 
             # Decide what matters by presence of f-curves
-            if curves_rotation and fcurves_keyframe_in_range(curves_rotation, frame_start, frame_end):
+            if curves_rotation and keyframes.in_range(curves_rotation, frame_start, frame_end):
                 seq.rotationMatters[index] = True
 
-            if curves_translation and fcurves_keyframe_in_range(curves_translation, frame_start, frame_end):
+            if curves_translation and keyframes.in_range(curves_translation, frame_start, frame_end):
                 seq.translationMatters[index] = True
 
-            if curves_scale and fcurves_keyframe_in_range(curves_scale, frame_start, frame_end):
+            if curves_scale and keyframes.in_range(curves_scale, frame_start, frame_end):
                 seq.scaleMatters[index] = True
 
+            # Drop tracks that stay at the pose the node would have anyway
+            track = samples[:, store.columns[ob]]
+
+            cleared = eliminate_constant_tracks(seq, index, track, base_translation, base_rotation)
+            constant_tracks += cleared
+            constant_keys += cleared * seq.numKeyframes
+
+            tracks.append((index, track))
+            bases.append((base_translation, base_rotation))
+
+        # Fewer, further apart keyframes where the motion allows it
+        if resample is not None:
+            resampled = resample_tracks(seq, tracks, *resample)
+        else:
+            resampled = [track for _, track in tracks]
+
+        for (index, _), track, (base_translation, base_rotation) in zip(tracks, resampled, bases):
             # Write the data where it matters
-            for frame in frame_indices:
-                translation, rotation, scale = animation_data[frame][node]
+            for row in track.tolist():
+                translation, rotation, scale = sample_transform(row)
 
                 if seq.translationMatters[index]:
                     if seq.flags & Sequence.Blend:
@@ -719,6 +1182,15 @@ def save(operator, context, filepath,
                 if seq.scaleMatters[index]:
                     shape.node_aligned_scales.append(scale)
 
+    if constant_tracks:
+        print("Removed {} constant tracks, saving {} keys".format(constant_tracks, constant_keys))
+
+    if prune_unused_nodes:
+        if dsq_compat:
+            print("Note: Not pruning nodes, DSQ compatibility needs every node in place")
+        else:
+            prune_nodes(shape)
+
     if debug_report:
         print("Writing debug report")
         write_debug_report(filepath + ".txt", shape)
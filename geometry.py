@@ -0,0 +1,727 @@
+import numpy as np
+from math import sqrt
+
+class Geometry:
+    """Indexed triangle geometry of a single exported mesh, stored as arrays"""
+
+    def __init__(self, verts, normals, tverts, tris, materials, source):
+        self.verts = verts          # (n, 3) float32 positions
+        self.normals = normals      # (n, 3) float32 unit normals
+        self.tverts = tverts        # (n, 2) float32 texture coordinates
+        self.tris = tris            # (t, 3) vertex indices per triangle
+        self.materials = materials  # (t,) primitive material flags per triangle
+        self.source = source        # (n,) index of the Blender vertex each vertex came from
+
+def normalized(vectors):
+    lengths = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    lengths[lengths == 0] = 1
+    return vectors / lengths[:, None]
+
+def transform_points(mat, points):
+    mat = np.asarray(mat, dtype=np.float64)
+    return points.dot(mat[:3, :3].T) + mat[:3, 3]
+
+def material_groups(materials):
+    """Split a material-sorted triangle array into (flags, first, end) runs"""
+    if not len(materials):
+        return []
+
+    starts = np.flatnonzero(np.diff(materials)) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [len(materials)]))
+
+    return [(int(materials[start]), int(start), int(end)) for start, end in zip(starts, ends)]
+
+def sort_by_material(geom):
+    order = np.argsort(geom.materials, kind="mergesort")
+    geom.tris = geom.tris[order]
+    geom.materials = geom.materials[order]
+
+def quantize(values, step):
+    return np.round(values / step).astype(np.int64)
+
+def unique_rows(keys):
+    """Find unique rows of an integer array, numbered in order of first use"""
+    keys = np.ascontiguousarray(keys)
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+
+    return first[order], remap[inverse.ravel()]
+
+def weld(geom, use_source=False, position_step=1e-5, normal_step=1e-4, tvert_step=1e-5):
+    """Merge vertices with the same quantized position, normal and texture coordinate.
+
+    With use_source, only vertices that came from the same Blender vertex are
+    merged, which keeps skin influences intact.
+    """
+    keys = [
+        quantize(geom.verts, position_step),
+        quantize(geom.normals, normal_step),
+        quantize(geom.tverts, tvert_step),
+    ]
+
+    if use_source:
+        keys.append(geom.source[:, None].astype(np.int64))
+
+    keep, remap = unique_rows(np.hstack(keys))
+
+    return Geometry(
+        geom.verts[keep], geom.normals[keep], geom.tverts[keep],
+        remap[geom.tris], geom.materials, geom.source[keep])
+
+def stripify(tris):
+    """Greedily cover a triangle list with strips stitched by degenerate triangles.
+
+    Triangles keep their winding: even strip triangles are (s[k], s[k+1], s[k+2])
+    and odd ones (s[k+1], s[k], s[k+2]), matching the list order of tris.
+    """
+    tris = tris.tolist()
+    edges = {}
+
+    for index, (a, b, c) in enumerate(tris):
+        edges.setdefault((a, b), index)
+        edges.setdefault((b, c), index)
+        edges.setdefault((c, a), index)
+
+    used = [False] * len(tris)
+
+    def third(index, p, q):
+        a, b, c = tris[index]
+        if (a, b) == (p, q): return c
+        if (b, c) == (p, q): return a
+        return b
+
+    def neighbor(p, q):
+        index = edges.get((p, q))
+        if index is None or used[index]:
+            return None
+        return index
+
+    strip = []
+
+    for start, (a, b, c) in enumerate(tris):
+        if used[start]:
+            continue
+
+        used[start] = True
+
+        # Pick the rotation that can continue into a neighbor, if any
+        for first in ((a, b, c), (b, c, a), (c, a, b)):
+            if neighbor(first[2], first[1]) is not None:
+                break
+        else:
+            first = (a, b, c)
+
+        current = list(first)
+
+        while True:
+            p, q = current[-2], current[-1]
+
+            if len(current) % 2 == 0:
+                index = neighbor(p, q)
+                if index is None:
+                    break
+                vertex = third(index, p, q)
+            else:
+                index = neighbor(q, p)
+                if index is None:
+                    break
+                vertex = third(index, q, p)
+
+            used[index] = True
+            current.append(vertex)
+
+        if strip:
+            # Stitch with degenerate triangles, keeping the new strip on an
+            # even position so its winding is preserved
+            strip.append(strip[-1])
+            strip.append(current[0])
+            if len(strip) % 2 == 1:
+                strip.append(current[0])
+
+        strip.extend(current)
+
+    return strip
+
+def strip_triangles(strip):
+    """Expand a strip into the non-degenerate triangles it covers, in list winding"""
+    tris = []
+
+    for k in range(len(strip) - 2):
+        if k % 2 == 0:
+            tri = (strip[k], strip[k + 1], strip[k + 2])
+        else:
+            tri = (strip[k + 1], strip[k], strip[k + 2])
+
+        if tri[0] != tri[1] and tri[1] != tri[2] and tri[0] != tri[2]:
+            tris.append(tri)
+
+    return tris
+
+def tipsify(tris, cache_size=16):
+    """Reorder triangles for the post-transform vertex cache.
+
+    Tipsify from Sander, Nehab and Barczak, "Fast Triangle Reordering for
+    Vertex Locality and Reduced Overdraw" (2007). Returns the new order.
+    """
+    if not len(tris):
+        return np.arange(0)
+
+    verts, local = np.unique(tris, return_inverse=True)
+    local = local.reshape(-1, 3)
+    num_verts = len(verts)
+
+    # Vertex to triangle adjacency in compressed form
+    flat = local.ravel()
+    adjacency_order = np.argsort(flat, kind="mergesort")
+    adjacency = (adjacency_order // 3).tolist()
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(flat, minlength=num_verts)))).tolist()
+
+    local = local.tolist()
+    live = np.bincount(flat, minlength=num_verts).tolist()
+    cache_time = [0] * num_verts
+    emitted = [False] * len(local)
+    dead_end = []
+    order = []
+
+    time = cache_size + 1
+    cursor = 1
+    fanning = 0
+
+    while fanning >= 0:
+        candidates = []
+
+        for t in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+
+            for v in local[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+
+            emitted[t] = True
+            order.append(t)
+
+        # Prefer candidates that will still be in the cache once their
+        # remaining triangles are emitted, oldest first
+        best = -1
+        best_priority = -1
+
+        for v in candidates:
+            if live[v] <= 0:
+                continue
+
+            priority = 0
+            if time - cache_time[v] + 2 * live[v] <= cache_size:
+                priority = time - cache_time[v]
+
+            if priority > best_priority:
+                best = v
+                best_priority = priority
+
+        if best == -1:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    best = v
+                    break
+
+        if best == -1:
+            while cursor < num_verts:
+                if live[cursor] > 0:
+                    best = cursor
+                    break
+                cursor += 1
+
+        fanning = best
+
+    return np.array(order, dtype=np.int64)
+
+def reorder_vertices(geom):
+    """Renumber vertices in the order the index buffer first uses them"""
+    keep, remap = unique_rows(geom.tris.reshape(-1, 1))
+
+    used = geom.tris.ravel()[keep]
+
+    return Geometry(
+        geom.verts[used], geom.normals[used], geom.tverts[used],
+        remap.reshape(-1, 3), geom.materials, geom.source[used])
+
+def optimize_vertex_cache(geom, cache_size=16):
+    sort_by_material(geom)
+
+    for flags, first, end in material_groups(geom.materials):
+        geom.tris[first:end] = geom.tris[first:end][tipsify(geom.tris[first:end], cache_size)]
+
+    return reorder_vertices(geom)
+
+def cache_miss_ratios(tris, cache_size=16):
+    """Simulate a FIFO post-transform cache, returning (ACMR, ATVR)"""
+    if not len(tris):
+        return 0.0, 0.0
+
+    cache = []
+    cached = set()
+    misses = 0
+
+    for v in np.asarray(tris).ravel().tolist():
+        if v in cached:
+            continue
+
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+
+        if len(cache) > cache_size:
+            cached.discard(cache.pop(0))
+
+    return misses / len(tris), misses / len(np.unique(tris))
+
+def submesh(geom, tri_indices):
+    """Copy a subset of triangles along with only the vertices they reference"""
+    tris = geom.tris[tri_indices]
+    used, local = np.unique(tris, return_inverse=True)
+
+    return Geometry(
+        geom.verts[used], geom.normals[used], geom.tverts[used],
+        local.reshape(-1, 3), geom.materials[tri_indices], geom.source[used])
+
+def spatial_chunks(geom, tri_indices, max_tris):
+    if len(tri_indices) <= max_tris:
+        return [tri_indices]
+
+    # Cut at the median along the longest axis of the triangle centroids
+    centroids = geom.verts[geom.tris[tri_indices]].mean(axis=1)
+    axis = np.argmax(np.ptp(centroids, axis=0))
+    order = np.argsort(centroids[:, axis], kind="mergesort")
+    half = len(order) // 2
+
+    return (spatial_chunks(geom, tri_indices[order[:half]], max_tris) +
+            spatial_chunks(geom, tri_indices[order[half:]], max_tris))
+
+def split_geometry(geom, max_indices=65535):
+    """Partition geometry into pieces with at most max_indices indices each.
+
+    Material groups are kept whole where they fit, and larger groups are cut
+    spatially. The chunks are then packed into as few pieces as possible.
+    """
+    max_tris = max_indices // 3
+
+    if len(geom.tris) <= max_tris:
+        return [geom]
+
+    sort_by_material(geom)
+    chunks = []
+
+    for flags, first, end in material_groups(geom.materials):
+        chunks.extend(spatial_chunks(geom, np.arange(first, end), max_tris))
+
+    pieces = []
+    current = []
+    count = 0
+
+    for chunk in chunks:
+        if current and count + len(chunk) > max_tris:
+            pieces.append(np.concatenate(current))
+            current = []
+            count = 0
+
+        current.append(chunk)
+        count += len(chunk)
+
+    pieces.append(np.concatenate(current))
+
+    return [submesh(geom, piece) for piece in pieces]
+
+def point_bounds(points, center=(0.0, 0.0, 0.0)):
+    """Box, sphere radius and tube radius of points around center in one pass.
+
+    Returns (min, max, radius, tube_radius). The tube radius is measured in
+    the XY plane, around the Z axis through center.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+    if not len(points):
+        return np.zeros(3), np.zeros(3), 0.0, 0.0
+
+    delta = points - center
+    squares = delta * delta
+    tube = squares[:, 0] + squares[:, 1]
+
+    return (points.min(axis=0), points.max(axis=0),
+            float(np.sqrt((tube + squares[:, 2]).max())), float(np.sqrt(tube.max())))
+
+def circumsphere(support):
+    """Smallest sphere with up to four points on its surface"""
+    support = np.asarray(support, dtype=np.float64)
+    origin = support[0]
+
+    if len(support) == 1:
+        return origin, 0.0
+
+    edges = support[1:] - origin
+    gram = edges.dot(edges.T)
+    rhs = 0.5 * np.einsum("ij,ij->i", edges, edges)
+
+    # Solved in the affine hull of the points; lstsq copes with degenerate sets
+    weights = np.linalg.lstsq(gram, rhs, rcond=-1)[0]
+    center = origin + weights.dot(edges)
+
+    return center, float(np.sqrt(((support - center) ** 2).sum(axis=1).max()))
+
+def welzl(points, support=()):
+    center, radius = circumsphere(support) if support else (None, -1.0)
+
+    if len(support) == 4:
+        return center, radius
+
+    for index, point in enumerate(points):
+        if center is not None and np.sum((point - center) ** 2) <= radius * radius * (1 + 1e-9):
+            continue
+
+        center, radius = welzl(points[:index], support + (point,))
+
+    return center, radius
+
+def ritter_sphere(points, max_iterations=64):
+    first = points[np.argmax(np.sum((points - points[0]) ** 2, axis=1))]
+    second = points[np.argmax(np.sum((points - first) ** 2, axis=1))]
+    center = (first + second) / 2
+    radius = np.sqrt(np.sum((second - first) ** 2)) / 2
+
+    # Grow the sphere towards the farthest outside point until it covers all
+    for _ in range(max_iterations):
+        distances = np.sqrt(np.sum((points - center) ** 2, axis=1))
+        farthest = np.argmax(distances)
+
+        if distances[farthest] <= radius * (1 + 1e-6):
+            break
+
+        new_radius = (radius + distances[farthest]) / 2
+        center = center + (points[farthest] - center) * ((new_radius - radius) / distances[farthest])
+        radius = new_radius
+
+    return center, float(np.sqrt(np.sum((points - center) ** 2, axis=1).max()))
+
+def bounding_sphere(points, max_iterations=100):
+    """Minimum enclosing sphere of points, returned as (center, radius).
+
+    A Ritter sphere gives a quick upper bound. The exact sphere is then found
+    by running Welzl's algorithm on a small support set, adding the farthest
+    outside point each round until every point is covered.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+    if not len(points):
+        return np.zeros(3), 0.0
+
+    ritter_center, ritter_radius = ritter_sphere(points)
+
+    # Start from the extreme points along each axis
+    extremes = np.concatenate((points.argmin(axis=0), points.argmax(axis=0)))
+    support = points[np.unique(extremes)]
+
+    # Seeded so that exporting the same scene twice gives identical files
+    random = np.random.RandomState(0)
+
+    for _ in range(max_iterations):
+        center, radius = welzl(support[random.permutation(len(support))])
+        distances = np.sum((points - center) ** 2, axis=1)
+        farthest = np.argmax(distances)
+
+        if distances[farthest] <= radius * radius * (1 + 1e-9):
+            break
+
+        support = np.vstack((support, points[farthest]))
+
+    # Make sure the sphere really encloses everything
+    radius = float(np.sqrt(np.sum((points - center) ** 2, axis=1).max()))
+
+    if ritter_radius < radius:
+        return ritter_center, ritter_radius
+
+    return center, radius
+
+def split_bone_palettes(geom, vertex_bones, max_bones):
+    """Partition skinned geometry into pieces that each use at most max_bones bones.
+
+    vertex_bones holds the set of bones influencing each vertex. Triangles
+    using the same bones are kept together, and those groups are packed
+    greedily, preferring the ones that add the fewest new bones to a piece
+    and then those sharing the most bones with it.
+    """
+    groups = {}
+
+    for index, tri in enumerate(geom.tris.tolist()):
+        bones = frozenset().union(*(vertex_bones[v] for v in tri))
+        groups.setdefault(bones, []).append(index)
+
+    if len(frozenset().union(*groups)) <= max_bones:
+        return [geom]
+
+    pieces = []
+
+    while groups:
+        palette = set()
+        tri_indices = []
+
+        while True:
+            best = None
+            best_key = None
+
+            for bones, indices in groups.items():
+                new_bones = len(bones - palette)
+
+                # A group too large for any palette still gets a piece of its own
+                if tri_indices and len(palette) + new_bones > max_bones:
+                    continue
+
+                key = (new_bones, -len(bones & palette), -len(indices))
+
+                if best_key is None or key < best_key:
+                    best = bones
+                    best_key = key
+
+            if best is None:
+                break
+
+            palette |= best
+            tri_indices.extend(groups.pop(best))
+
+        pieces.append(submesh(geom, np.array(sorted(tri_indices))))
+
+    return pieces
+
+def merge_geometries(geoms):
+    """Concatenate geometry from several meshes in the same space into one.
+
+    The source indices of each part are shifted past those of the parts
+    before it, so they stay unique per (mesh, vertex) pair. They no longer
+    index a single Blender mesh, which is why skinned meshes are not merged.
+    """
+    offsets = np.cumsum([0] + [len(geom.verts) for geom in geoms[:-1]])
+    source_offsets = np.cumsum([0] + [int(geom.source.max()) + 1 if len(geom.source) else 0
+                                      for geom in geoms[:-1]])
+
+    return Geometry(
+        np.concatenate([geom.verts for geom in geoms]),
+        np.concatenate([geom.normals for geom in geoms]),
+        np.concatenate([geom.tverts for geom in geoms]),
+        np.concatenate([geom.tris + offset for geom, offset in zip(geoms, offsets)]),
+        np.concatenate([geom.materials for geom in geoms]),
+        np.concatenate([geom.source + offset for geom, offset in zip(geoms, source_offsets)]))
+
+def cull_triangles(geom, min_area=1e-10):
+    """Remove degenerate and exactly duplicated triangles, along with unused vertices.
+
+    A triangle is degenerate when two of its indices are equal or its area is
+    at most min_area. Duplicates use the same vertices with the same winding
+    and material; back-to-back faces are kept. Returns the new geometry and
+    the number of degenerate and duplicate triangles removed.
+    """
+    tris = geom.tris
+    a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+
+    corners = geom.verts[tris].astype(np.float64)
+    cross = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = 0.5 * np.sqrt(np.einsum("ij,ij->i", cross, cross))
+
+    valid = (a != b) & (b != c) & (a != c) & (areas > min_area)
+    keep = np.flatnonzero(valid)
+
+    # Rotate each triangle so its smallest index comes first, keeping winding
+    rotated = tris[keep]
+    shift = np.argmin(rotated, axis=1)
+    columns = (shift[:, None] + np.arange(3)) % 3
+    rotated = rotated[np.arange(len(rotated))[:, None], columns]
+
+    keys = np.hstack((rotated, geom.materials[keep, None])).astype(np.int64)
+    first, _ = unique_rows(keys)
+    unique = keep[np.sort(first)]
+
+    num_degenerate = len(tris) - len(keep)
+    num_duplicate = len(keep) - len(unique)
+
+    if not num_degenerate and not num_duplicate:
+        return geom, 0, 0
+
+    return submesh(geom, unique), num_degenerate, num_duplicate
+
+def triangle_quadrics(points, tris):
+    """Area-weighted plane quadrics of triangles as the 10 unique coefficients"""
+    corners = points[tris]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+    normals = normals / np.where(lengths == 0, 1, lengths)[:, None]
+
+    a, b, c = normals.T
+    d = -np.einsum("ij,ij->i", normals, corners[:, 0])
+
+    return np.stack((a * a, a * b, a * c, a * d, b * b, b * c, b * d, c * c, c * d, d * d), axis=1) * (lengths / 2)[:, None]
+
+def quadric_error(q, x, y, z):
+    return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x +
+            q[4] * y * y + 2 * q[5] * y * z + 2 * q[6] * y +
+            q[7] * z * z + 2 * q[8] * z + q[9])
+
+def triangle_normal(a, b, c):
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+def decimate(geom, target_tris, max_normal_change=0.2, min_quality=0.01):
+    """Reduce geometry to about target_tris triangles by quadric-error edge collapse.
+
+    Vertices are collapsed onto a neighbor (half-edge collapse) in order of
+    Garland and Heckbert's quadric error, so no new vertices or attributes
+    are made. Vertices on UV seams, hard edges, material borders and open
+    boundaries never move, which keeps those borders intact. Collapses that
+    would flip or crush a triangle, or make the surface non-manifold, are
+    skipped; max_normal_change is the smallest cosine allowed between a
+    triangle's normal before and after, and min_quality the smallest ratio
+    of twice its area to its longest edge squared.
+    """
+    import heapq
+
+    if len(geom.tris) <= target_tris:
+        return geom
+
+    # Work on positions, so the split copies of a vertex move as one
+    keep, pid = unique_rows(quantize(geom.verts, 1e-5))
+    points = geom.verts[keep].astype(np.float64)
+    num_points = len(points)
+
+    quadrics = np.zeros((num_points, 10))
+    np.add.at(quadrics, pid[geom.tris].ravel(),
+              np.repeat(triangle_quadrics(points, pid[geom.tris]), 3, axis=0))
+
+    points = points.tolist()
+    quadrics = quadrics.tolist()
+    tri_verts = geom.tris.tolist()
+    tri_pids = pid[geom.tris].tolist()
+    materials = geom.materials.tolist()
+
+    tris_of = [set() for _ in range(num_points)]
+    wedges = [set() for _ in range(num_points)]
+    point_materials = [set() for _ in range(num_points)]
+    edge_count = {}
+
+    for t, (verts, pids) in enumerate(zip(tri_verts, tri_pids)):
+        for k in range(3):
+            p = pids[k]
+            tris_of[p].add(t)
+            wedges[p].add(verts[k])
+            point_materials[p].add(materials[t])
+
+            edge = (min(p, pids[k - 1]), max(p, pids[k - 1]))
+            edge_count[edge] = edge_count.get(edge, 0) + 1
+
+    locked = [len(wedges[p]) > 1 or len(point_materials[p]) > 1 for p in range(num_points)]
+
+    for (p, q), count in edge_count.items():
+        if count != 2:
+            locked[p] = locked[q] = True
+
+    alive_tris = [True] * len(tri_verts)
+    stamps = [0] * num_points
+    live = len(tri_verts)
+
+    def neighbors(p):
+        return {q for t in tris_of[p] for q in tri_pids[t]} - {p}
+
+    heap = []
+
+    def push(u, v):
+        if not locked[u]:
+            q = [a + b for a, b in zip(quadrics[u], quadrics[v])]
+            heapq.heappush(heap, (quadric_error(q, *points[v]), u, v, stamps[u], stamps[v]))
+
+    for p, q in edge_count:
+        push(p, q)
+        push(q, p)
+
+    while live > target_tris and heap:
+        _, u, v, stamp_u, stamp_v = heapq.heappop(heap)
+
+        if stamp_u != stamps[u] or stamp_v != stamps[v] or not tris_of[u]:
+            continue
+
+        shared = tris_of[u] & tris_of[v]
+
+        if not shared:
+            continue
+
+        # Keep the surface manifold: an interior edge has exactly two opposite vertices
+        if len(neighbors(u) & neighbors(v)) != 2:
+            continue
+
+        # The copy of v that the triangles moving over from u will use
+        v_wedges = {tri_verts[t][tri_pids[t].index(v)] for t in shared}
+
+        if len(v_wedges) != 1:
+            continue
+
+        v_wedge = v_wedges.pop()
+        moved = tris_of[u] - shared
+        valid = True
+
+        for t in moved:
+            before = triangle_normal(*(points[p] for p in tri_pids[t]))
+            after = triangle_normal(*(points[v if p == u else p] for p in tri_pids[t]))
+
+            dot = before[0] * after[0] + before[1] * after[1] + before[2] * after[2]
+            length = sqrt((before[0] ** 2 + before[1] ** 2 + before[2] ** 2) *
+                          (after[0] ** 2 + after[1] ** 2 + after[2] ** 2))
+
+            if dot <= max_normal_change * length or length == 0:
+                valid = False
+                break
+
+            # Nor crush it into a sliver
+            corners = [points[v if p == u else p] for p in tri_pids[t]]
+            longest = max(sum((corners[i][k] - corners[i - 1][k]) ** 2 for k in range(3)) for i in range(3))
+            area = sqrt(after[0] ** 2 + after[1] ** 2 + after[2] ** 2)
+
+            if area < min_quality * longest:
+                valid = False
+                break
+
+        if not valid:
+            continue
+
+        for t in shared:
+            alive_tris[t] = False
+            live -= 1
+
+            for p in tri_pids[t]:
+                tris_of[p].discard(t)
+
+        for t in moved:
+            k = tri_pids[t].index(u)
+            tri_pids[t][k] = v
+            tri_verts[t][k] = v_wedge
+            tris_of[v].add(t)
+
+        tris_of[u].clear()
+        quadrics[v] = [a + b for a, b in zip(quadrics[u], quadrics[v])]
+        stamps[u] += 1
+        stamps[v] += 1
+
+        for w in neighbors(v):
+            push(w, v)
+            push(v, w)
+
+    decimated = Geometry(geom.verts, geom.normals, geom.tverts,
+                         np.array(tri_verts, dtype=geom.tris.dtype).reshape(-1, 3),
+                         geom.materials, geom.source)
+
+    return submesh(decimated, np.flatnonzero(alive_tris))
@@ -26,11 +26,12 @@ def get_free_name(name, taken):
 # action.fcurves[].keyframe_points[].co
 
 def load(operator, context, filepath,
+         sequence_filter=None,
          debug_report=False):
   dsq = DsqFile()
 
   with open(filepath, "rb") as fd:
-    dsq.read(fd)
+    dsq.read(fd, sequence_filter)
 
   if debug_report:
       with open(filepath + ".txt", "w") as fd:
@@ -99,6 +100,9 @@ def load(operator, context, filepath,
 
   # Create Blender keyframes and markers for each sequence
   for seq in dsq.sequences:
+    if sequence_filter is not None and seq.name not in sequence_filter:
+      continue
+
     name = get_free_name(seq.name, scene_sequences)
     print("found seq", seq.name, "to", name)
 
@@ -1,10 +1,13 @@
 import bpy
 import os
+import hashlib
+from array import array
 from bpy_extras.io_utils import unpack_list
 
 from .DtsShape import DtsShape
 from .DtsTypes import *
 from .write_report import write_debug_report
+from .import_sequence import import_sequence
 from .util import default_materials, resolve_texture, get_rgb_colors, fail, \
     ob_location_curves, ob_scale_curves, ob_rotation_curves, ob_rotation_data, evaluate_all
 
@@ -29,15 +32,48 @@ def dedup_name(group, name):
         if new_name not in group:
             return new_name
 
-def import_material(color_source, dmat, filepath):
-    bmat = bpy.data.materials.new(dedup_name(bpy.data.materials, dmat.name))
-    bmat.diffuse_intensity = 1
+def datablock_cache(collection, key):
+    return {block[key]: block for block in collection if key in block}
+
+def load_image(image_cache, texname):
+    path = os.path.normcase(os.path.abspath(texname))
+    mtime = os.path.getmtime(path)
+    image = image_cache.get(path)
+
+    if image is not None:
+        if image.get("dtsMtime") != mtime:
+            print("Reloading changed image", texname)
+            image.reload()
+            image["dtsMtime"] = mtime
+
+        return image
+
+    image = bpy.data.images.load(texname)
+    image["dtsPath"] = path
+    image["dtsMtime"] = mtime
+    image_cache[path] = image
 
+    return image
+
+def import_material(color_source, dmat, filepath, material_cache, image_cache):
     texname = resolve_texture(filepath, dmat.name)
 
+    if texname is None:
+        key = "{}:{}:".format(dmat.name, dmat.flags)
+    else:
+        key = "{}:{}:{}".format(dmat.name, dmat.flags, os.path.normcase(os.path.abspath(texname)))
+
+    if key in material_cache:
+        return material_cache[key]
+
+    bmat = bpy.data.materials.new(dedup_name(bpy.data.materials, dmat.name))
+    bmat.diffuse_intensity = 1
+    bmat["dtsMaterial"] = key
+    material_cache[key] = bmat
+
     if texname is not None:
         try:
-            teximg = bpy.data.images.load(texname)
+            teximg = load_image(image_cache, texname)
         except:
             print("Cannot load image", texname)
 
@@ -93,6 +129,52 @@ class index_pass:
     def __getitem__(self, item):
         return item
 
+def mesh_hash(dmesh, shape, materials):
+    h = hashlib.sha1()
+
+    h.update(array("f", unpack_list(dmesh.verts)).tobytes())
+    h.update(array("f", unpack_list(dmesh.normals)).tobytes())
+    h.update(array("f", unpack_list(dmesh.tverts)).tobytes())
+    h.update(array("i", dmesh.indices).tobytes())
+
+    for prim in dmesh.primitives:
+        h.update(array("I", (prim.firstElement, prim.numElements, prim.type)).tobytes())
+
+        # The Blender material, not just the DTS one: the same name and flags
+        # resolve to different textures depending on where the file is
+        if not (prim.type & Primitive.NoMaterial):
+            dmat = shape.materials[prim.type & Primitive.MaterialMask]
+            h.update(materials[dmat].name.encode("utf-8"))
+
+    # Deform weights live in the mesh datablock, so skinning is part of it too
+    h.update(array("I", (len(dmesh.bones),)).tobytes())
+    h.update(array("i", [index for vertex, bone, _ in dmesh.influences for index in (vertex, bone)]).tobytes())
+    h.update(array("f", [weight for _, _, weight in dmesh.influences]).tobytes())
+
+    return h.hexdigest()
+
+def bmesh_contents(me):
+    """Hash the current geometry of a Blender mesh, to notice later edits"""
+    h = hashlib.sha1()
+
+    co = array("f", [0.0]) * (len(me.vertices) * 3)
+    me.vertices.foreach_get("co", co)
+    h.update(co.tobytes())
+
+    loop_verts = array("i", [0]) * len(me.loops)
+    me.loops.foreach_get("vertex_index", loop_verts)
+    h.update(loop_verts.tobytes())
+
+    for uv_layer in me.uv_layers:
+        uvs = array("f", [0.0]) * (len(uv_layer.data) * 2)
+        uv_layer.data.foreach_get("uv", uvs)
+        h.update(uvs.tobytes())
+
+    for bmat in me.materials:
+        h.update((bmat.name if bmat else "").encode("utf-8"))
+
+    return h.hexdigest()
+
 def create_bmesh(dmesh, materials, shape):
     me = bpy.data.meshes.new("Mesh")
 
@@ -196,12 +278,26 @@ def insert_reference(frame, shape_nodes):
 def load(operator, context, filepath,
          reference_keyframe=True,
          import_sequences=True,
+         sequence_mode="timeline",
          use_armature=False,
+         sequence_filter=None,
          debug_report=False):
     shape = DtsShape()
 
+    if not import_sequences:
+        sequence_filter = set()
+
+    # Bones have no per-node objects to lay a shared timeline out on
+    if use_armature and sequence_mode != "actions":
+        print("Importing sequences as actions, the timeline is not supported with an armature")
+        sequence_mode = "actions"
+
+    # The debug report re-saves the shape, so it needs every keyframe
+    if debug_report:
+        sequence_filter = None
+
     with open(filepath, "rb") as fd:
-        shape.load(fd)
+        shape.load(fd, sequence_filter)
 
     if debug_report:
         write_debug_report(filepath + ".txt", shape)
@@ -212,8 +308,13 @@ def load(operator, context, filepath,
     materials = {}
     color_source = get_rgb_colors()
 
+    # Reuse materials and images created by earlier imports where possible
+    material_cache = datablock_cache(bpy.data.materials, "dtsMaterial")
+    image_cache = datablock_cache(bpy.data.images, "dtsPath")
+
     for dmat in shape.materials:
-        materials[dmat] = import_material(color_source, dmat, filepath)
+        materials[dmat] = import_material(color_source, dmat, filepath,
+                                          material_cache, image_cache)
 
     # Now assign IFL material properties where needed
     for ifl in shape.iflmaterials:
@@ -316,6 +417,10 @@ def load(operator, context, filepath,
 
         for seq in shape.sequences:
             name = shape.names[seq.nameIndex]
+
+            if sequence_filter is not None and name not in sequence_filter:
+                continue
+
             print("Importing sequence", name)
 
             flags = []
@@ -332,6 +437,13 @@ def load(operator, context, filepath,
             if flags:
                 sequences_text.append(name + ": " + ", ".join(flags))
 
+            if sequence_mode == "actions":
+                if use_armature:
+                    import_sequence(shape, seq, name, armature_ob=root_ob, bone_names=bone_names)
+                else:
+                    import_sequence(shape, seq, name, node_obs=node_obs)
+                continue
+
             nodesRotation = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(shape.nodes, seq.rotationMatters))))
             nodesTranslation = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(shape.nodes, seq.translationMatters))))
             nodesScale = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(shape.nodes, seq.scaleMatters))))
@@ -424,6 +536,9 @@ def load(operator, context, filepath,
 
         sequences_buf.from_string("\n".join(sequences_text))
 
+    mesh_cache = datablock_cache(bpy.data.meshes, "dtsHash")
+    fresh_meshes = set()
+
     # Then put objects in the armatures
     for obj in shape.objects:
         if obj.node == -1:
@@ -443,11 +558,33 @@ def load(operator, context, filepath,
                     meshIndex + 1, mtype, shape.names[obj.name]))
                 continue
 
-            bmesh = create_bmesh(mesh, materials, shape)
+            # Reuse identical geometry as a linked duplicate. Meshes from
+            # earlier imports are only trusted if nobody edited them since.
+            digest = mesh_hash(mesh, shape, materials)
+            bmesh = mesh_cache.get(digest)
+
+            if bmesh is not None and digest not in fresh_meshes:
+                if bmesh.get("dtsContents") != bmesh_contents(bmesh):
+                    # Edited since; stop offering it for reuse
+                    del bmesh["dtsHash"]
+                    bmesh = None
+                else:
+                    fresh_meshes.add(digest)
+
+            reused = bmesh is not None
+
+            if not reused:
+                bmesh = create_bmesh(mesh, materials, shape)
+                bmesh["dtsHash"] = digest
+                bmesh["dtsContents"] = bmesh_contents(bmesh)
+                mesh_cache[digest] = bmesh
+                fresh_meshes.add(digest)
+
             bobj = bpy.data.objects.new(dedup_name(bpy.data.objects, shape.names[obj.name]), bmesh)
             context.scene.objects.link(bobj)
 
-            add_vertex_groups(mesh, bobj, shape)
+            # A reused mesh already holds these weights in its deform vertices
+            add_vertex_groups(mesh, bobj, shape, write_weights=not reused)
 
             if use_armature:
                 bobj.parent = root_ob
@@ -487,10 +624,23 @@ def load(operator, context, filepath,
 
     return {"FINISHED"}
 
-def add_vertex_groups(mesh, ob, shape):
+def add_vertex_groups(mesh, ob, shape, weight_steps=1024, write_weights=True):
     for node, initial_transform in mesh.bones:
         # TODO: Handle initial_transform
         ob.vertex_groups.new(shape.names[shape.nodes[node].name])
 
+    if not write_weights:
+        return
+
+    # Collect vertices sharing the same bone and weight so that each group
+    # only needs one call per distinct weight instead of one per influence.
+    # Painted weights are rarely exactly equal, so they are snapped to
+    # weight_steps levels first.
+    batches = {}
+
     for vertex, bone, weight in mesh.influences:
-        ob.vertex_groups[bone].add((vertex,), weight, 'REPLACE')
+        level = int(round(weight * weight_steps))
+        batches.setdefault((bone, level), []).append(vertex)
+
+    for (bone, level), vertices in batches.items():
+        ob.vertex_groups[bone].add(vertices, level / weight_steps, 'REPLACE')
@@ -1,84 +1,152 @@
-# This file is currently unused
-
 import bpy
 
-def import_sequence(is_dsq, shape, seq):
-    if is_dsq:
-        name = shape.names[seq.nameIndex]
-    else:
-        name = seq.name
-    
-    act = bpy.data.actions.new(name)
-    
-    flags = ["priority {}".format(seq.priority)]
-    if seq.flags & Sequence.Cyclic:
-        flags.append("cyclic")
-    if seq.flags & Sequence.Blend:
-        flags.append("blend")
-    # sequences_text.append(name + ": " + ", ".join(flags))
-
-    if is_dsq:
-        nodes = shape.nodes
-        rotations = shape.rotations
-    else:
-        nodes = tuple(map(lambda n: shape.names[n.name], shape.nodes))
-        rotations = shape.node_rotations
-    
+from .DtsTypes import Sequence, Vector
+
+def matters_nodes(matters, num_nodes):
+    return [index for index, bit in enumerate(matters[:num_nodes]) if bit]
+
+def sequence_tracks(seq, matters, num_nodes, base, table):
+    for matters_index, node_index in enumerate(matters_nodes(matters, num_nodes)):
+        first = base + matters_index * seq.numKeyframes
+        yield node_index, table[first:first + seq.numKeyframes]
+
+def fix_quaternion_signs(rotations):
+    # Keep neighbouring keys in the same hemisphere so F-curves interpolate
+    # along the short path
+    fixed = []
+
+    for rot in rotations:
+        if fixed and fixed[-1].dot(rot) < 0:
+            rot = -rot
+
+        fixed.append(rot)
+
+    return fixed
+
+def keyframe_curves(action, data_path, values, group=None):
+    if not values:
+        return
+
+    frames = range(1, len(values) + 1)
+    co = [0.0] * (len(values) * 2)
+    co[0::2] = frames
+
+    # foreach_set takes enum values as integers
+    linear = bpy.types.Keyframe.bl_rna.properties["interpolation"].enum_items["LINEAR"].value
+    interpolation = [linear] * len(values)
+
+    for array_index in range(len(values[0])):
+        if group is None:
+            curve = action.fcurves.new(data_path, array_index)
+        else:
+            curve = action.fcurves.new(data_path, array_index, group)
+
+        co[1::2] = [value[array_index] for value in values]
+
+        curve.keyframe_points.add(len(values))
+        curve.keyframe_points.foreach_set("co", co)
+        curve.keyframe_points.foreach_set("interpolation", interpolation)
+
+        curve.update()
+
+def sequence_scales(seq, shape):
+    # Tables of a filtered load hold None for sequences that were skipped, so
+    # uniform scales are only turned into vectors per track
     if seq.flags & Sequence.UniformScale:
-        scales = tuple(map(lambda s: (s, s, s), shape.uniform_scales))
+        return shape.node_uniform_scales
     elif seq.flags & Sequence.AlignedScale:
-        scales = shape.aligned_scales
+        return shape.node_aligned_scales
     elif seq.flags & Sequence.ArbitraryScale:
         print("Warning: Arbitrary scale animation not implemented")
-        break
     else:
         print("Warning: Invalid scale flags found in sequence")
-        break
-    
-    nodes_translation = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(nodes, seq.translationMatters))))
-    nodes_rotation = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(nodes, seq.rotationMatters))))
-    nodes_scale = tuple(map(lambda p: p[0], filter(lambda p: p[1], zip(nodes, seq.scaleMatters))))
-
-    for matters_index, node_name in enumerate(nodes_translation):
-        data_path = 'pose.bones["{}"].location'.format(node_name)
-        fcus = tuple(map(lambda array_index: act.fcurves.new(data_path, array_index), range(3)))
-        for frame_index in range(seq.numKeyframes):
-            array = translations[seq.baseTranslation + matters_index * seq.numKeyframes + frame_index]
-            for array_index, fcu in enumerate(fcus):
-                fcu.keyframe_points.add(1)
-                key = fcu.keyframe_points[-1]
-                key.interpolation = "LINEAR"
-                key.co = (1 + frame_index, array[array_index])
-
-    for matters_index, node_name in enumerate(nodes_rotation):
-        data_path = 'pose.bones["{}"].rotation_quaternion'.format(node_name)
-        fcus = tuple(map(lambda array_index: act.fcurves.new(data_path, array_index), range(4)))
-        for frame_index in range(seq.numKeyframes):
-            array = rotations[seq.baseRotation + matters_index * seq.numKeyframes + frame_index]
-            for array_index, fcu in enumerate(fcus):
-                fcu.keyframe_points.add(1)
-                key = fcu.keyframe_points[-1]
-                key.interpolation = "LINEAR"
-                key.co = (1 + frame_index, array[array_index])
-    
-    for matters_index, node_name in enumerate(nodes_scale):
-        data_path = 'pose.bones["{}"].scale'.format(node_name)
-        fcus = tuple(map(lambda array_index: act.fcurves.new(data_path, array_index), range(3)))
-        for frame_index in range(seq.numKeyframes):
-            array = scales[seq.baseScale + matters_index * seq.numKeyframes + frame_index]
-            for array_index, fcu in enumerate(fcus):
-                fcu.keyframe_points.add(1)
-                key = fcu.keyframe_points[-1]
-                key.interpolation = "LINEAR"
-                key.co = (1 + frame_index, array[array_index])
-
-    # if seq.flags & Sequence.Blend:
-    #     if reference_frame is None:
-    #     return fail(operator, "Missing 'reference' marker for blend animation '{}'".format(name))
-    #     ref_vec = Vector(evaluate_all(curves, reference_frame))
-    #     vec = ref_vec + vec
-    # if seq.flags & Sequence.Blend:
-    #     if reference_frame is None:
-    #     return fail(operator, "Missing 'reference' marker for blend animation '{}'".format(name))
-    #     ref_rot = Quaternion(evaluate_all(curves, reference_frame))
-    #     rot = ref_rot * rot
+
+def new_action(name):
+    action = bpy.data.actions.new(name)
+    action.use_fake_user = True
+    return action
+
+def import_sequence(shape, seq, name, node_obs=None, armature_ob=None, bone_names=None):
+    """Import a sequence into its own actions instead of the shared timeline.
+
+    With an armature, the sequence becomes a single action on the pose bones.
+    Otherwise every animated node empty gets an action of its own.
+    """
+    num_nodes = len(shape.nodes)
+    is_blend = seq.flags & Sequence.Blend
+    use_armature = armature_ob is not None
+
+    if use_armature:
+        armature_action = new_action(name)
+
+        if not armature_ob.animation_data:
+            armature_ob.animation_data_create()
+        if not armature_ob.animation_data.action:
+            armature_ob.animation_data.action = armature_action
+
+    node_actions = {}
+
+    def target(node_index, data_path):
+        node_name = shape.names[shape.nodes[node_index].name]
+
+        if use_armature:
+            return (armature_action,
+                    'pose.bones["{}"].{}'.format(bone_names[node_index], data_path),
+                    node_name)
+
+        action = node_actions.get(node_index)
+
+        if action is None:
+            ob = node_obs[node_index]
+            action = node_actions[node_index] = new_action("{}_{}".format(name, ob.name))
+
+            if not ob.animation_data:
+                ob.animation_data_create()
+            if not ob.animation_data.action:
+                ob.animation_data.action = action
+
+        return action, data_path, None
+
+    for node_index, translations in sequence_tracks(
+            seq, seq.translationMatters, num_nodes,
+            seq.baseTranslation, shape.node_translations):
+        default_translation = shape.default_translations[node_index]
+        default_rotation = shape.default_rotations[node_index]
+
+        if is_blend:
+            translations = [default_translation + vec for vec in translations]
+
+        if use_armature:
+            # Pose bones are relative to the rest pose
+            rest_inverse = default_rotation.inverted()
+            translations = [rest_inverse * (vec - default_translation) for vec in translations]
+
+        action, data_path, group = target(node_index, "location")
+        keyframe_curves(action, data_path, translations, group)
+
+    for node_index, rotations in sequence_tracks(
+            seq, seq.rotationMatters, num_nodes,
+            seq.baseRotation, shape.node_rotations):
+        default_rotation = shape.default_rotations[node_index]
+
+        if is_blend:
+            rotations = [default_rotation * rot for rot in rotations]
+
+        if use_armature:
+            rest_inverse = default_rotation.inverted()
+            rotations = [rest_inverse * rot for rot in rotations]
+
+        action, data_path, group = target(node_index, "rotation_quaternion")
+        keyframe_curves(action, data_path, fix_quaternion_signs(rotations), group)
+
+    scales = sequence_scales(seq, shape)
+
+    if scales is not None:
+        for node_index, node_scales in sequence_tracks(
+                seq, seq.scaleMatters, num_nodes,
+                seq.baseScale, scales):
+            if seq.flags & Sequence.UniformScale:
+                node_scales = [Vector((s, s, s)) for s in node_scales]
+
+            action, data_path, group = target(node_index, "scale")
+            keyframe_curves(action, data_path, node_scales, group)
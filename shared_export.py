@@ -1,5 +1,10 @@
 from collections import OrderedDict
 import bpy
+import numpy as np
+from mathutils import Euler, Matrix, Quaternion, Vector
+
+from .DtsTypes import Sequence
+from .util import array_from_fcurves, array_from_fcurves_rotation, ob_rotation_data
 
 def find_seqs(scene, select_marker):
     sequences = OrderedDict()
@@ -44,4 +49,325 @@ def find_seqs(scene, select_marker):
 
         sequences[name][what] = marker
 
-    return sequences, sequence_flags
\ No newline at end of file
+    return sequences, sequence_flags
+
+def fcurve_only_reason(ob):
+    """Why an object's local transform can't be sampled from its F-curves alone, or None"""
+    data = ob.animation_data
+
+    if ob.constraints:
+        return "constraints"
+    if data.drivers:
+        return "drivers"
+    if any(not track.mute for track in data.nla_tracks):
+        return "NLA tracks"
+    if ob.parent is not None and ob.parent_type != "OBJECT":
+        return "{} parenting".format(ob.parent_type.lower())
+    if tuple(ob.delta_location) != (0, 0, 0) or tuple(ob.delta_scale) != (1, 1, 1) or \
+            tuple(ob.delta_rotation_quaternion) != (1, 0, 0, 0) or \
+            tuple(ob.delta_rotation_euler) != (0, 0, 0):
+        return "delta transforms"
+
+def evaluate_fcurve(curve, frames):
+    """Evaluate an F-curve at every frame, interpolating keys in bulk where possible"""
+    keys = curve.keyframe_points
+
+    co = np.empty(len(keys) * 2, dtype=np.float32)
+    keys.foreach_get("co", co)
+    x, y = co[0::2], co[1::2]
+
+    if len(keys) and not curve.modifiers and curve.extrapolation == "CONSTANT":
+        interpolation = {key.interpolation for key in keys}
+
+        if interpolation <= {"LINEAR"}:
+            return np.interp(frames, x, y)
+        if interpolation <= {"CONSTANT"}:
+            return y[np.clip(np.searchsorted(x, frames, side="right") - 1, 0, None)]
+
+    return np.array([curve.evaluate(frame) for frame in frames], dtype=np.float64)
+
+def evaluate_channels(curves, static, frames):
+    values = np.empty((len(frames), len(static)))
+
+    for index, value in enumerate(static):
+        curve = curves[index] if curves else None
+
+        if curve is None or curve.mute:
+            values[:, index] = value
+        else:
+            values[:, index] = evaluate_fcurve(curve, frames)
+
+    return values
+
+def sample_fcurve_transforms(ob, frames):
+    """Sample the local transform of an object from its action at each frame.
+
+    Returns (frame count, 10) rows of translation, rotation quaternion (w, x,
+    y, z) and scale, matching what matrix_local.decompose() would give.
+    """
+    fcurves = ob.animation_data.action.fcurves
+    frames = np.asarray(frames, dtype=np.float64)
+
+    location = evaluate_channels(
+        array_from_fcurves(fcurves, "location", 3), ob.location, frames)
+    rotation = evaluate_channels(
+        array_from_fcurves_rotation(fcurves, ob), ob_rotation_data(ob), frames)
+    scale = evaluate_channels(
+        array_from_fcurves(fcurves, "scale", 3), ob.scale, frames)
+
+    has_parent_inverse = ob.parent is not None and ob.matrix_parent_inverse != Matrix.Identity(4)
+
+    if ob.rotation_mode == "QUATERNION" and not has_parent_inverse:
+        lengths = np.sqrt(np.einsum("ij,ij->i", rotation, rotation))
+        lengths[lengths == 0] = 1
+        return np.hstack((location, rotation / lengths[:, None], scale))
+
+    samples = np.empty((len(frames), 10))
+
+    for row, (loc, rot, scl) in enumerate(zip(location.tolist(), rotation.tolist(), scale.tolist())):
+        if ob.rotation_mode == "QUATERNION":
+            rot = Quaternion(rot).normalized()
+        elif ob.rotation_mode == "AXIS_ANGLE":
+            rot = Quaternion(rot[1:], rot[0])
+        else:
+            rot = Euler(rot, ob.rotation_mode).to_quaternion()
+
+        mat = Matrix.Translation(loc) * rot.to_matrix().to_4x4() * Matrix((
+            (scl[0], 0, 0, 0), (0, scl[1], 0, 0), (0, 0, scl[2], 0), (0, 0, 0, 1)))
+
+        if ob.parent is not None:
+            mat = ob.matrix_parent_inverse * mat
+
+        loc, rot, scl = mat.decompose()
+        samples[row] = tuple(loc) + tuple(rot) + tuple(scl)
+
+    return samples
+
+def sequence_frame_range(sequences):
+    """First and last frame covered by any sequence with both markers"""
+    ranges = [(markers["start"].frame, markers["end"].frame)
+              for markers in sequences.values()
+              if "start" in markers and "end" in markers]
+
+    if not ranges:
+        return 0, -1
+
+    return min(start for start, _ in ranges), max(end for _, end in ranges)
+
+def sample_transform(row):
+    return Vector(row[0:3]), Quaternion(row[3:7]), Vector(row[7:10])
+
+class SampleStore:
+    """Local transforms of animated objects over the frames of an export run.
+
+    Samples are kept in a frames x objects x 10 array of translation,
+    rotation quaternion and scale, and each frame is sampled the first time a
+    sequence asks for it. Objects animated purely by their action are
+    evaluated from F-curves; the rest need scene.frame_set, which is only
+    done when there are any.
+    """
+
+    def __init__(self, scene, objects, frame_start, frame_end):
+        self.scene = scene
+        self.frame_start = frame_start
+        self.columns = {ob: column for column, ob in enumerate(objects)}
+        self.curve_obs = []
+        self.scene_obs = []
+
+        for ob in objects:
+            reason = fcurve_only_reason(ob)
+
+            if reason is None:
+                self.curve_obs.append(ob)
+            else:
+                print("  '{}' is sampled with frame_set ({})".format(ob.name, reason))
+                self.scene_obs.append(ob)
+
+        if self.curve_obs:
+            print("  Sampling {} of {} nodes from F-curves".format(len(self.curve_obs), len(objects)))
+
+        num_frames = max(0, frame_end - frame_start + 1)
+        self.samples = np.zeros((num_frames, len(objects), 10))
+        self.sampled = np.zeros(num_frames, dtype=bool)
+
+        print("  Sample store: {} frames x {} nodes, {:.1f} KiB".format(
+            num_frames, len(objects), self.samples.nbytes / 1024))
+
+    def sample(self, frame_start, frame_end):
+        """Return the frames x objects x 10 samples of a frame range"""
+        first = frame_start - self.frame_start
+        end = frame_end - self.frame_start + 1
+
+        missing = first + np.flatnonzero(~self.sampled[first:end])
+
+        if len(missing):
+            frames = missing + self.frame_start
+
+            for ob in self.curve_obs:
+                self.samples[missing, self.columns[ob]] = sample_fcurve_transforms(ob, frames)
+
+            if self.scene_obs:
+                for row, frame in zip(missing.tolist(), frames.tolist()):
+                    self.scene.frame_set(frame)
+
+                    for ob in self.scene_obs:
+                        loc, rot, scl = ob.matrix_local.decompose()
+                        self.samples[row, self.columns[ob]] = tuple(loc) + tuple(rot) + tuple(scl)
+
+            self.sampled[missing] = True
+
+        return self.samples[first:end]
+
+# How far a sampled track may stray from the default pose and still be dropped
+translation_tolerance = 1e-5
+rotation_tolerance = 1e-4 # radians
+scale_tolerance = 1e-5
+
+def eliminate_constant_tracks(seq, index, track, translation, rotation):
+    """Clear the matters bits of tracks that never leave the default pose.
+
+    track is the frames x 10 samples of the node. A track that is constant at
+    some other value still has to be written, since without it the node
+    would snap back to its default pose. Returns the number of tracks cleared.
+    """
+    cleared = 0
+
+    if seq.translationMatters[index] and \
+            np.abs(track[:, 0:3] - tuple(translation)).max() <= translation_tolerance:
+        seq.translationMatters[index] = False
+        cleared += 1
+
+    if seq.rotationMatters[index]:
+        dots = np.clip(np.abs(np.dot(track[:, 3:7], tuple(rotation))), 0, 1)
+
+        if 2 * np.arccos(dots.min()) <= rotation_tolerance:
+            seq.rotationMatters[index] = False
+            cleared += 1
+
+    if seq.scaleMatters[index] and np.abs(track[:, 7:10] - 1).max() <= scale_tolerance:
+        seq.scaleMatters[index] = False
+        cleared += 1
+
+    return cleared
+
+def slerp(a, b, t):
+    """Spherical interpolation between rows of unit quaternions"""
+    dots = np.einsum("ij,ij->i", a, b)
+    b = np.where(dots[:, None] < 0, -b, b)
+    dots = np.abs(dots)
+
+    angles = np.arccos(np.clip(dots, -1, 1))
+    sines = np.sin(angles)
+    small = sines < 1e-6
+    sines[small] = 1
+
+    wa = np.where(small, 1 - t, np.sin((1 - t) * angles) / sines)
+    wb = np.where(small, t, np.sin(t * angles) / sines)
+
+    result = a * wa[:, None] + b * wb[:, None]
+    return result / np.sqrt(np.einsum("ij,ij->i", result, result))[:, None]
+
+def key_positions(num_keys, count, cyclic):
+    """Positions of count evenly spaced sequence times on a track of num_keys keys"""
+    if cyclic:
+        return np.arange(count) * (num_keys / count)
+
+    return np.arange(count) * ((num_keys - 1) / max(count - 1, 1))
+
+def interpolate_track(track, positions, cyclic):
+    """Sample a frames x 10 track at fractional key positions like the engine does"""
+    num_keys = len(track)
+    first = np.floor(positions).astype(np.int64)
+    t = positions - first
+
+    if cyclic:
+        first %= num_keys
+        second = (first + 1) % num_keys
+    else:
+        first = np.clip(first, 0, num_keys - 1)
+        second = np.clip(first + 1, 0, num_keys - 1)
+
+    a, b = track[first], track[second]
+    result = a + (b - a) * t[:, None]
+    result[:, 3:7] = slerp(a[:, 3:7], b[:, 3:7], t)
+
+    return result
+
+def resample_track(track, num_keys, cyclic):
+    return interpolate_track(track, key_positions(len(track), num_keys, cyclic), cyclic)
+
+def track_errors(track, num_keys, cyclic):
+    """Largest translation, rotation and scale error of playing a track back with num_keys keys"""
+    keys = resample_track(track, num_keys, cyclic)
+    played = interpolate_track(keys, key_positions(num_keys, len(track), cyclic), cyclic)
+
+    delta = played - track
+    dots = np.clip(np.abs(np.einsum("ij,ij->i", played[:, 3:7], track[:, 3:7])), 0, 1)
+
+    return (np.sqrt(np.einsum("ij,ij->i", delta[:, 0:3], delta[:, 0:3]).max()),
+            2 * np.arccos(dots.min()),
+            np.sqrt(np.einsum("ij,ij->i", delta[:, 7:10], delta[:, 7:10]).max()))
+
+def fit_keyframe_count(tracks, cyclic, translation_error, rotation_error):
+    """Smallest uniform number of keyframes that reproduces every track within tolerance.
+
+    tracks is a list of (frames x 10 samples, (translation, rotation, scale)
+    matters) pairs; only channels that matter are compared.
+    """
+    num_frames = len(tracks[0][0])
+    limits = (translation_error, rotation_error, translation_error)
+
+    def fits(num_keys):
+        for track, matters in tracks:
+            errors = track_errors(track, num_keys, cyclic)
+
+            if any(used and error > limit for used, error, limit in zip(matters, errors, limits)):
+                return False
+
+        return True
+
+    # The error shrinks almost monotonically with the key count, so bisect.
+    # Every frame as a key is exact, and only counts that fit are returned.
+    low, high = 2, num_frames
+
+    while low < high:
+        middle = (low + high) // 2
+
+        if fits(middle):
+            high = middle
+        else:
+            low = middle + 1
+
+    return high
+
+def resample_tolerances(data):
+    """Parse the 'resample [translation [rotation in degrees]]' sequence flag"""
+    values = data.split() if data else []
+    translation = float(values[0]) if len(values) > 0 else 0.001
+    rotation = float(values[1]) if len(values) > 1 else 0.25
+
+    return translation, np.radians(rotation)
+
+def resample_tracks(seq, tracks, translation_error, rotation_error):
+    """Resample the tracks of a sequence to the fewest keyframes within tolerance.
+
+    tracks is a list of (node index, frames x 10 samples). Updates
+    seq.numKeyframes and returns the resampled samples in the same order.
+    The duration is unchanged, so the keys are simply spread further apart.
+    """
+    if not tracks or seq.numKeyframes < 3:
+        return [track for _, track in tracks]
+
+    cyclic = bool(seq.flags & Sequence.Cyclic)
+    matters = [(track, (seq.translationMatters[index], seq.rotationMatters[index], seq.scaleMatters[index]))
+               for index, track in tracks]
+
+    num_keys = fit_keyframe_count(matters, cyclic, translation_error, rotation_error)
+
+    if num_keys == seq.numKeyframes:
+        return [track for _, track in tracks]
+
+    print("  Resampled from {} to {} keyframes".format(seq.numKeyframes, num_keys))
+    seq.numKeyframes = num_keys
+
+    return [resample_track(track, num_keys, cyclic) for _, track in tracks]
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="session")
+def addon():
+    """The add-on imported as a package. Needs Blender's bpy, so run these
+    tests with Blender's Python."""
+    pytest.importorskip("bpy")
+
+    if "io_scene_dts" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "io_scene_dts", os.path.join(ROOT, "__init__.py"),
+            submodule_search_locations=[ROOT])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["io_scene_dts"] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules["io_scene_dts"]
@@ -0,0 +1,71 @@
+import struct
+import zlib
+
+def write_png(path, color):
+    """A 1x1 RGB PNG"""
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, "wb") as fd:
+        fd.write(b"\x89PNG\r\n\x1a\n")
+        fd.write(chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)))
+        fd.write(chunk(b"IDAT", zlib.compress(b"\x00" + bytes(color))))
+        fd.write(chunk(b"IEND", b""))
+
+def write_triangle_shape(path):
+    from io_scene_dts.DtsShape import DtsShape
+    from io_scene_dts.DtsTypes import Node, Object, ObjectState, Subshape, DetailLevel, \
+        Mesh, Primitive, Material, Vector, Quaternion
+
+    shape = DtsShape()
+    shape.nodes.append(Node(shape.name("root")))
+    shape.default_translations.append(Vector())
+    shape.default_rotations.append(Quaternion())
+    shape.objects.append(Object(shape.name("triangle"), 1, 0, 0))
+    shape.objectstates.append(ObjectState(1.0, 0, 0))
+    shape.subshapes.append(Subshape(0, 0, 0, 1, 1, 0))
+    shape.detail_levels.append(DetailLevel(shape.name("detail32"), 0, 0, 32.0))
+    shape.materials.append(Material(name="skin", flags=Material.NeverEnvMap))
+
+    mesh = Mesh(Mesh.StandardType)
+    mesh.verts = [Vector((0, 0, 0)), Vector((1, 0, 0)), Vector((0, 1, 0))]
+    mesh.normals = [Vector((0, 0, 1))] * 3
+    mesh.enormals = [0] * 3
+    mesh.tverts = [Vector((0, 0)), Vector((1, 0)), Vector((0, 1))]
+    mesh.indices = [0, 1, 2]
+    mesh.primitives = [Primitive(0, 3, Primitive.Triangles | Primitive.Indexed | 0)]
+    mesh.vertsPerFrame = 3
+    shape.meshes.append(mesh)
+
+    with open(path, "wb") as fd:
+        shape.save(fd)
+
+def import_triangle(path):
+    import bpy
+    from io_scene_dts import import_dts
+
+    before = set(bpy.data.objects)
+    import_dts.load(None, bpy.context, str(path), import_sequences=False)
+    return next(ob for ob in set(bpy.data.objects) - before if ob.name.startswith("triangle"))
+
+def test_mesh_reuse_follows_texture_root(addon, tmp_path):
+    paths = []
+
+    for name, color in (("red", (255, 0, 0)), ("blue", (0, 0, 255))):
+        root = tmp_path / name
+        root.mkdir()
+        write_png(str(root / "skin.png"), color)
+        write_triangle_shape(str(root / "shape.dts"))
+        paths.append(root / "shape.dts")
+
+    red = import_triangle(paths[0])
+    blue = import_triangle(paths[1])
+    red_again = import_triangle(paths[0])
+
+    # Same geometry, but the material resolves to another texture
+    assert blue.data != red.data
+    assert blue.data.materials[0] != red.data.materials[0]
+
+    # Importing from the same place again still shares the mesh
+    assert red_again.data == red.data
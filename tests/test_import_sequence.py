@@ -0,0 +1,55 @@
+import io
+
+def uniform_scale_shape():
+    from io_scene_dts.DtsShape import DtsShape
+    from io_scene_dts.DtsTypes import Node, Subshape, DetailLevel, Sequence, Vector, Quaternion
+
+    shape = DtsShape()
+    shape.nodes.append(Node(shape.name("root")))
+    shape.default_translations.append(Vector())
+    shape.default_rotations.append(Quaternion())
+    shape.subshapes.append(Subshape(0, 0, 0, 1, 0, 0))
+    shape.detail_levels.append(DetailLevel(shape.name("detail32"), 0, 0, 32.0))
+
+    for index, name in enumerate(("a", "b")):
+        seq = Sequence()
+        seq.nameIndex = shape.name(name)
+        seq.flags = Sequence.UniformScale
+        seq.numKeyframes = 3
+        seq.duration = 1.0
+        seq.baseScale = len(shape.node_uniform_scales)
+        seq.rotationMatters = [False]
+        seq.translationMatters = [False]
+        seq.scaleMatters = [True]
+
+        for attr in ("decalMatters", "iflMatters", "visMatters", "frameMatters", "matFrameMatters"):
+            setattr(seq, attr, [False])
+
+        shape.node_uniform_scales.extend(index + 1 + key / 2 for key in range(3))
+        shape.sequences.append(seq)
+
+    fd = io.BytesIO()
+    shape.save(fd)
+    fd.seek(0)
+    return fd
+
+def test_filtered_uniform_scale_sequence(addon):
+    import bpy
+    from io_scene_dts.DtsShape import DtsShape
+    from io_scene_dts.import_sequence import import_sequence
+
+    shape = DtsShape()
+    shape.load(uniform_scale_shape(), {"b"})
+
+    # The skipped sequence leaves holes in the keyframe table
+    assert None in shape.node_uniform_scales
+
+    seq = next(seq for seq in shape.sequences if shape.names[seq.nameIndex] == "b")
+    ob = bpy.data.objects.new("root", None)
+    import_sequence(shape, seq, "b", node_obs={0: ob})
+
+    curves = ob.animation_data.action.fcurves
+    assert len(curves) == 3
+
+    for curve in curves:
+        assert [key.co[1] for key in curve.keyframe_points] == [2.0, 2.5, 3.0]
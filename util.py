@@ -1,5 +1,6 @@
 import os
 import bpy
+import numpy as np
 from colorsys import hsv_to_rgb
 from itertools import count
 from fractions import Fraction
@@ -144,14 +145,35 @@ def array_from_fcurves_rotation(curves, ob):
     data_path, array_count = fcurves_path_from_rotation(ob)
     return array_from_fcurves(curves, data_path, array_count)
 
-def fcurves_keyframe_in_range(curves, start, end):
-    for curve in curves:
-        for keyframe in curve.keyframe_points:
-            frame = keyframe.co[0]
-            if frame >= start and frame <= end:
+class KeyframeCache:
+    """Sorted keyframe frames of F-curves, read once per export"""
+
+    def __init__(self):
+        self.frames = {}
+
+    def curve_frames(self, curve):
+        frames = self.frames.get(curve)
+
+        if frames is None:
+            co = np.empty(len(curve.keyframe_points) * 2, dtype=np.float32)
+            curve.keyframe_points.foreach_get("co", co)
+            frames = self.frames[curve] = np.sort(co[0::2])
+
+        return frames
+
+    def in_range(self, curves, start, end):
+        """Whether any of the curves has a keyframe between start and end, inclusive"""
+        for curve in curves:
+            if curve is None:
+                continue
+
+            frames = self.curve_frames(curve)
+            first = np.searchsorted(frames, start)
+
+            if first < len(frames) and frames[first] <= end:
                 return True
 
-    return False
+        return False
 
 def find_reference(scene):
     reference_marker = scene.timeline_markers.get("reference")
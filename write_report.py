@@ -1,4 +1,18 @@
 from .DtsTypes import *
+from .geometry import strip_triangles, cache_miss_ratios
+
+def mesh_triangles(mesh):
+    tris = []
+
+    for prim in mesh.primitives:
+        indices = mesh.indices[prim.firstElement:prim.firstElement + prim.numElements]
+
+        if prim.type & Primitive.Strip:
+            tris.extend(strip_triangles(indices))
+        elif not (prim.type & Primitive.Fan):
+            tris.extend(zip(indices[0::3], indices[1::3], indices[2::3]))
+
+    return tris
 
 def write_debug_report(filepath, shape):
     with open(filepath, "w") as fd:
@@ -119,6 +133,8 @@ def write_debug_report(filepath, shape):
             p("    bounds = " + str(mesh.bounds))
             p("    center = " + str(mesh.center))
             p("    radius = " + str(mesh.radius))
+            acmr, atvr = cache_miss_ratios(mesh_triangles(mesh))
+            p("    vertex cache (FIFO 16): ACMR = {:.3f}, ATVR = {:.3f}".format(acmr, atvr))
             # p("    numFrames = " + str(mesh.numFrames))
             # p("    numMatFrames = " + str(mesh.numMatFrames))
             # p("    vertsPerFrame = " + str(mesh.vertsPerFrame))
@@ -155,6 +171,8 @@ def write_debug_report(filepath, shape):
                 for i, (node_index, initial_transform) in enumerate(mesh.bones):
                     p("      bone{} node={} initial_transform={}".format(i, node_index, initial_transform))
                 p("    + Influences ({}): <omitted>".format(len(mesh.influences)))
+                if hasattr(mesh, "unlimited_influences"):
+                    p("      before limiting: {}, after: {}".format(mesh.unlimited_influences, len(mesh.influences)))
                 # for vi, bi, w in mesh.influences:
                 #     p
                 #     p("      influence vert{} bone{} weight={}".format(vi, bi, w))